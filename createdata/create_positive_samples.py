@@ -1,7 +1,6 @@
 from re import X
 from typing import List
 import numpy as np
-import math
 import pandas as pd
 import os.path
 from PIL import Image
@@ -10,32 +9,7 @@ import matplotlib.pyplot as plt
 from typing import List, Dict, Tuple
 import pickle
 
-
-def tile2long(x, z):
-    return x / math.pow(2, z) * 360 - 180
-
-
-def tile2lat(y, z):
-    n = math.pi - 2 * math.pi * y / math.pow(2, z)
-    return 180 / math.pi * math.atan(0.5 * (math.exp(n) - math.exp(-n)))
-
-
-def long2tile(lon, zoom):
-    return math.floor((lon + 180) / 360 * math.pow(2, zoom))
-
-
-def lat2tile(lat, zoom):
-    return math.floor(
-        (
-            1
-            - math.log(
-                math.tan(lat * math.pi / 180) + 1 / math.cos(lat * math.pi / 180)
-            )
-            / math.pi
-        )
-        / 2
-        * math.pow(2, zoom)
-    )
+from anaspingpong import geo, tiling
 
 
 def plot_single_image(image_array: np.ndarray, figsize=(100, 150)) -> None:
@@ -110,9 +84,15 @@ def load_merge_tiles(
 
     tiles_y_list = list(range(tile_y_first, tile_y_last))
     tiles_x_list = list(range(tile_x_first, tile_x_last))
-    len_group = len(tiles_y_list)
-    # Initialize
-    tiles_appended = np.zeros((len_group,) + (len_group,) + image_shape).astype(int)
+    width_tile = image_shape[0]
+    # Initialize the merged image, tiles are decoded straight into it
+    tiles_merged = np.zeros(
+        (len(tiles_y_list) * width_tile, len(tiles_x_list) * width_tile)
+        + image_shape[2:],
+        dtype=np.uint8,
+    )
+    # View of the merged image as tiles_y, tiles_x, pixels_x, pixels_y, RGB
+    tiles_appended = tiling.tile_grid(tiles_merged, width_tile)
 
     for iy, tl_y in enumerate(tiles_y_list):
         for ix, tl_x in enumerate(tiles_x_list):
@@ -125,8 +105,6 @@ def load_merge_tiles(
                 # plt.imshow(np.asarray(image_tmp))
                 # plt.show(block=False)
                 tiles_appended[iy, ix, :, :, :] = np.asarray(image_tmp)
-    tiles_merged = np.concatenate(tiles_appended, axis=1)  # along x-axis
-    tiles_merged = np.concatenate(tiles_merged, axis=1)  # along y-axis
     # plot_single_image(tiles_merged, figsize=(25, 25))
 
     return tiles_merged, tiles_appended
@@ -152,28 +130,6 @@ def create_map_w_tile_indices(
     return map_tile_indices
 
 
-def create_square_tiles(image: np.ndarray, tile_width: int) -> np.ndarray:
-    """Create square tiles of an image
-
-    Args:
-        image (np.array): input image as a 3-dim array: pixels_x, pixels_y, RGB
-        tile_width (int): width of tile
-
-    Returns:
-        np.array: tiles have two extra dimensions: tile_x(dim0), tile_y(dim1)
-    """
-
-    #  First split along y axis
-    # new dimenisons 1-4: tiles_y, pixels_x, pixels_y, RGB)
-    tiles = np.array(np.split(image, image.shape[1] // tile_width, axis=1))
-
-    # Then also splitting along the x axis
-    # new dimenisons 1-5: tiles_x, tiles_y, pixels_x, pixels_y, RGB)
-    # note: input axis is again 1 because previous step added one dimension => rows is now dim=1
-    tiles = np.array(np.split(tiles, tiles.shape[1] // tile_width, axis=1))
-    return tiles
-
-
 def select_tile(
     images_array: np.ndarray, info: dict, figsize=(100, 150)
 ) -> Dict[str, List]:
@@ -320,8 +276,9 @@ zoom = 20
 df_table = pd.read_csv(os.path.join(path_lat_long_reference, "lat_long.csv"))
 
 # Transform latitude to tile_y & longitude to tile_X
-df_table["tile_y"] = df_table.loc[:, "latitude"].apply(lambda y: lat2tile(y, zoom))
-df_table["tile_x"] = df_table.loc[:, "longitude"].apply(lambda x: long2tile(x, zoom))
+df_table["tile_x"], df_table["tile_y"] = geo.to_tiles(
+    df_table["latitude"].to_numpy(), df_table["longitude"].to_numpy(), zoom
+)
 
 # Shift types: "": no shift, r: horizontal-right, b:vertical-bottom, rb: both
 shift_types = ["r", "b", "rb"]
@@ -426,8 +383,8 @@ for id, tile_y, tile_x in tables_info_curr:
         # Initialize matrix for new 3x3 tiles group
         len_new_plot = 3
         tiles_group_plot = np.zeros(
-            (len_new_plot,) + (len_new_plot,) + image_shape
-        ).astype(int)
+            (len_new_plot,) + (len_new_plot,) + image_shape, dtype=np.uint8
+        )
 
         # Add original central tile in middle
         tiles_group_plot[1, 1, :, :, :] = np.asarray(image_centre)
@@ -436,28 +393,17 @@ for id, tile_y, tile_x in tables_info_curr:
             coord_tois_onshifted = coords_tois_onshifted[shift_fly]
             coord_tois_onnew = coords_tois_onnew[shift_fly]
 
-            xdim_orig, y_dim_orig, _ = tiles_merged.shape
+            # Offset of the shifted tiles from the corner of merged-tiles, half the width of a tile
             if shift_fly == "r":
-                tile_x_range = [0, xdim_orig]
-                tile_y_range = [width_tile // 2, -width_tile // 2]
+                offset = (0, width_tile // 2)
             elif shift_fly == "b":
-                tile_x_range = [width_tile // 2, -width_tile // 2]
-                tile_y_range = [0, y_dim_orig]
+                offset = (width_tile // 2, 0)
             elif shift_fly == "rb":
-                tile_x_range = [width_tile // 2, -width_tile // 2]
-                tile_y_range = [width_tile // 2, -width_tile // 2]
-
-            # Cut left-right and/or top-bottom edges of merged-tiles, by half the width of a tile
-            tiles_merged_cut = tiles_merged[
-                tile_x_range[0] : tile_x_range[1], tile_y_range[0] : tile_y_range[1], :
-            ]
-
-            # Inspect
-            # should be shorter at y_edges in "r", x_edges in "b", and at both edges with "rb"
-            # plot_single_image(tiles_merged_cut)
+                offset = (width_tile // 2, width_tile // 2)
 
-            # Create square tiles with dims same as original tiles
-            tiles_shifted = create_square_tiles(tiles_merged_cut, width_tile)
+            # Create square tiles with dims same as original tiles, as a view of merged-tiles
+            # they loose the last column in "r", last row in "b", and both with "rb"
+            tiles_shifted = tiling.windows(tiles_merged, width_tile, offset=offset)
 
             # Get TOIs add them to new tiles_group
             for coord_shift, coord_new in zip(coord_tois_onshifted, coord_tois_onnew):
@@ -526,7 +472,7 @@ for id, tile_y, tile_x in tables_info_curr:
 
                 # Get selected tile based on coords
                 selected_tile = tiles_group_plot[tile_coord[0], tile_coord[1], :, :, :]
-                im = Image.fromarray(selected_tile.astype(np.uint8))
+                im = Image.fromarray(selected_tile)
                 # im.show()
                 tile_y_save = coord_selected[0]
                 tile_x_save = coord_selected[1]
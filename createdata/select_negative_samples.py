@@ -5,6 +5,8 @@ from os import listdir
 from os.path import isfile, join
 import shutil
 
+from anaspingpong import quadkey
+
 # get min and max tile_x and tile_y in positive samples
 
 path_positive_tiles = (
@@ -48,23 +50,23 @@ max_val2 = max(sel_tiles_val_2)
 
 count_n_neg_samples = 0
 
-for val1 in range(min_val1, max_val1):
-    for val2 in range(min_val2, max_val2):
-        tile_v1v2 = [val1, val2]
-        if tile_v1v2 not in sel_tiles_v1v2:
-            # transfer from from database of all tiles to folder for negative_samples
-            path_orig = join(path_all_tiles, str(zoom), str(val1), str(val2) + ".jpeg")
-            filename = f"{str(zoom)}_{str(val1)}_{str(val2)}.jpeg"
-            path_dest = join(path_negative_tiles, filename)
-            # check if file exists in original data
-            if isfile(path_orig):
-                # If file already in training data folder -> skip
-                if isfile(path_dest):
-                    continue
-                shutil.copy(path_orig, path_dest)
-                count_n_neg_samples += 1
-        if count_n_neg_samples == 200:
-            break
+# walk the tiles in Z-order so the samples come from a compact area
+for val1, val2, _ in quadkey.zorder_tiles(
+    min_val1, min_val2, max_val1 - 1, max_val2 - 1, zoom
+):
+    tile_v1v2 = [val1, val2]
+    if tile_v1v2 not in sel_tiles_v1v2:
+        # transfer from from database of all tiles to folder for negative_samples
+        path_orig = join(path_all_tiles, str(zoom), str(val1), str(val2) + ".jpeg")
+        filename = f"{str(zoom)}_{str(val1)}_{str(val2)}.jpeg"
+        path_dest = join(path_negative_tiles, filename)
+        # check if file exists in original data
+        if isfile(path_orig):
+            # If file already in training data folder -> skip
+            if isfile(path_dest):
+                continue
+            shutil.copy(path_orig, path_dest)
+            count_n_neg_samples += 1
     if count_n_neg_samples == 200:
         break
 
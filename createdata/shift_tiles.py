@@ -1,8 +1,14 @@
+import multiprocessing
+import os
+import tempfile
+from functools import partial
 from PIL import Image
 import numpy as np
 import matplotlib.pyplot as plt
 
-from typing import Tuple
+from typing import Optional, Tuple
+
+from anaspingpong import tiling
 
 
 def plot_single_image(image_array: np.ndarray, figsize=(100, 150)) -> None:
@@ -53,234 +59,241 @@ def plot_multiple_images(images_array: np.ndarray, figsize=(100, 150)) -> None:
     plt.show(block=False)
 
 
-def load_merge_tiles(
+def tile_path(path_tiles_folder: str, tilex: int, tiley: int, suffix=".jpeg") -> str:
+    """Path of a tile, the folder is named after tiley and the file after tilex"""
+    return "/".join([path_tiles_folder, str(tiley), str(tilex) + suffix])
+
+
+def find_tile_width(
     path_tiles_folder: str,
     tile_x_first: int,
     tile_x_last: int,
     tile_y_first: int,
     tile_y_last: int,
-) -> Tuple[np.ndarray, np.ndarray, int]:
-    """Load tiles in a given range, append them together and then merge them in one 3-dim array (ie single image)
-
-    Args:
-        tile_x_first (int): [description]
-        tile_x_last (int): [description]
-        tile_y_first (int): [description]
-        tile_y_last (int): [description]
-
-    Returns:
-        Tuple[np.ndarray, np.ndarray]:
-        np.ndarray #1 : merged tiles in a 3-d array: pixels_x, pixels_y, RGB
-        np.ndarray #2 : non-merged appended tiles as a 5-d array: tiles_x, tiles_y, pixels_x, pixels_y, RGB
-        int : width of single tile
-    """
-
-    rows_appended = []  # to merge the tiles (for creating  shifted tiles)
-    tiles_appended = []  # to save tiles separately (for plotting purposes)
-
+) -> int:
+    """Width (=height) of the first tile found in the range. Only reads the header"""
     for tilex in range(tile_x_first, tile_x_last):
-        tiles_y_appended = []
         for tiley in range(tile_y_first, tile_y_last):
-            path_to_tile = "/".join(
-                [path_tiles_folder, str(tiley), str(tilex) + ".jpeg"]
-            )
-            image = Image.open(path_to_tile)  # image.show()
-            # TODO: Save to png?
-            # image.save("/".join([foldername_tiles, str(tiley), str(tilex) + ".png"]))
+            path_to_tile = tile_path(path_tiles_folder, tilex, tiley)
+            if os.path.isfile(path_to_tile):
+                with Image.open(path_to_tile) as image:
+                    return image.size[0]
+    raise FileNotFoundError(f"No tiles in {path_tiles_folder} for the given range")
 
-            image_array = np.asarray(image)  # image to 3D array (RGB)
-            tiles_y_appended.append(image_array)
 
-        # Concatenate along columns (ie y) to create a row
-        tiles_y_merged = np.concatenate(tiles_y_appended, axis=1)
+def decode_row(
+    path_tiles_folder: str,
+    tilex: int,
+    tile_y_first: int,
+    tile_y_last: int,
+    out: np.ndarray,
+) -> np.ndarray:
+    """Decode one row of tiles into a preallocated uint8 strip
 
-        # Append row to list-of rows that will be merged
-        rows_appended.append(tiles_y_merged)
+    Args:
+        out (np.ndarray): strip to decode into: width_tile, n_tiles_y * width_tile, RGB
 
-        # Append non-merged tiles to list of all tiles (no-merging here)
-        tiles_appended.append(tiles_y_appended)
+    Returns:
+        np.ndarray: boolean mask of the tiles that exist, missing ones are left black
+    """
+    width_tile = out.shape[0]
+    present = np.zeros(tile_y_last - tile_y_first, dtype=bool)
+    for iy, tiley in enumerate(range(tile_y_first, tile_y_last)):
+        columns = slice(iy * width_tile, (iy + 1) * width_tile)
+        try:
+            with Image.open(tile_path(path_tiles_folder, tilex, tiley)) as image:
+                out[:, columns] = image.convert("RGB")
+        except FileNotFoundError:
+            out[:, columns] = 0
+            continue
+        present[iy] = True
+    return present
+
+
+def save_tiles(
+    tiles: np.ndarray,
+    present: np.ndarray,
+    path_tiles_folder: str,
+    tilex: int,
+    tile_y_first: int,
+    str_to_attach: str,
+) -> int:
+    """Save a row of shifted tiles next to the originals, skipping tiles that overlap missing ones
+
+    Returns:
+        int: number of saved tiles
+    """
+    for iy in np.flatnonzero(present):
+        Image.fromarray(tiles[iy]).save(
+            tile_path(path_tiles_folder, tilex, tile_y_first + int(iy), str_to_attach)
+        )
+    return int(present.sum())
 
-    # Merge rows to create one image from all tiles
-    # concatenate along rows (ie x)
-    tiles_merged = np.concatenate(rows_appended, axis=0)
-    # plot_single_image(tiles_merged)
 
-    # Transform list of tiles to array for easier plotting
-    tiles_unmerged = np.array(tiles_appended)
-    # plot_multiple_images(tiles_unmerged, (100, 150))
+def save_row_shifts(
+    strip: np.ndarray,
+    present: np.ndarray,
+    path_tiles_folder: str,
+    tilex: int,
+    tile_y_first: int,
+    shifts: Tuple[str, ...],
+) -> int:
+    """Save the shifted tiles of a strip one tile high
 
-    # Return also the single tile's width (=height)
-    width_tile = image_array.shape[0]
+    For "h" the strip is a row of tiles and present its mask. For "v" and "hv" the
+    strip starts half a tile below row tilex and present is the mask of the tiles
+    of both rows. A horizontal shift looses the last column.
+    """
+    width_tile = strip.shape[0]
+    half = width_tile // 2
+    saved = 0
+    for shift in shifts:
+        if shift == "v":
+            tiles, mask = tiling.windows(strip, width_tile)[0], present
+        else:
+            tiles = tiling.windows(strip, width_tile, offset=(0, half))[0]
+            mask = present[:-1] & present[1:]
+        saved += save_tiles(
+            tiles, mask, path_tiles_folder, tilex, tile_y_first, f"_shift_{shift}.png"
+        )
+    return saved
 
-    return tiles_merged, tiles_unmerged, width_tile
 
+def shift_band(
+    path_tiles_folder: str,
+    width_tile: int,
+    tile_y_first: int,
+    tile_y_last: int,
+    path_memmap: Optional[str],
+    band: Tuple[int, int],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+    """Decode the rows of a band once each and save all their shifted tiles
 
-def create_square_tiles(image: np.ndarray, tile_width: int) -> np.ndarray:
-    """Create square tiles of an image
+    Only a rolling window of one and a half rows is kept: the bottom half of the
+    previous row on top of the current row, so the vertical shifts between them
+    are a contiguous slice. The vertical shifts between the last row of the band
+    and the first row of the next are left to the caller.
 
     Args:
-        image (np.array): input image as a 3-dim array: pixels_x, pixels_y, RGB
-        tile_width (int): width of tile
+        path_memmap (str, optional): folder to keep the window in a memory-mapped file
+        band (Tuple[int, int]): first and last (excluded) tilex of the band
 
     Returns:
-        np.array: tiles have two extra dimensions: tile_x(dim0), tile_y(dim1)
+        Tuple: top half of the first row, its mask, bottom half of the last row,
+        its mask and the number of saved tiles
     """
+    tile_x_first, tile_x_last = band
+    half = width_tile // 2
+    shape = (width_tile + half, (tile_y_last - tile_y_first) * width_tile, 3)
+    if path_memmap is None:
+        window = np.empty(shape, dtype=np.uint8)
+    else:
+        window = np.memmap(
+            tempfile.TemporaryFile(dir=path_memmap), dtype=np.uint8, mode="w+", shape=shape
+        )
+    previous, current = window[:half], window[half:]
 
-    #  First split along y axis
-    # new dimenisons 1-4: tiles_y, pixels_x, pixels_y, RGB)
-    tiles = np.array(np.split(image, image.shape[1] // tile_width, axis=1))
-
-    # Then also splitting along the x axis
-    # new dimenisons 1-5: tiles_x, tiles_y, pixels_x, pixels_y, RGB)
-    # note: input axis is again 1 because previous step added one dimension => rows is now dim=1
-    tiles = np.array(np.split(tiles, tiles.shape[1] // tile_width, axis=1))
-    return tiles
+    saved = 0
+    for tilex in range(tile_x_first, tile_x_last):
+        present = decode_row(path_tiles_folder, tilex, tile_y_first, tile_y_last, current)
+        if tilex == tile_x_first:
+            top, top_present = np.array(current[:half]), present
+        else:
+            saved += save_row_shifts(
+                window[:width_tile], above & present,
+                path_tiles_folder, tilex - 1, tile_y_first, ("v", "hv"),
+            )
+        saved += save_row_shifts(
+            current, present, path_tiles_folder, tilex, tile_y_first, ("h",)
+        )
+        previous[:] = current[half:]
+        above = present
+    return top, top_present, np.array(previous), above, saved
 
 
-def save_shifted_tiles(
-    tiles_shifted: np.ndarray,
+def shift_tiles(
     path_tiles_folder: str,
-    str_to_attach: str,
     tile_x_first: int,
     tile_x_last: int,
     tile_y_first: int,
     tile_y_last: int,
-) -> None:
-    """Saves the tiles using same name as original plus a string that defines the applied shift
-    (shift_h: horizontal, shift_v: vertical, shift_hv : horizontal & vertical)
-
-    Args:
-        path_tiles_folder (str): path to folder where tiles are
-        str_to_attach (str): attached to end of file, should index the shift type (h, v, hv)
-        tile_x_first (int): [description]
-        tile_x_last (int): [description]
-        tile_y_first (int): [description]
-        tile_y_last (int): [description]
-    """
-
-    for ix, tilex in enumerate(range(tile_x_first, tile_x_last)):
-        for iy, tiley in enumerate(range(tile_y_first, tile_y_last)):
-            im = Image.fromarray(tiles_shifted[ix, iy, :, :, :])
-            im.save(
-                "/".join([path_tiles_folder, str(tiley), str(tilex) + str_to_attach])
-            )
-
-
-# Provide needed information
-
-foldername_tiles = r"/home/geomi/gm/projects/dsr/portfolio_project/MapTilesDownloader/src/output/googlemaps_data/21"
-# Define first and last tiles in both x and y dimensions
-tile_y_first = 1125826
-tile_y_last = 1125856
-tile_x_first = 687247
-tile_x_last = 687264
-
-# Database is huge. Define how many tiles do you want to load & transform per run
-n_tiles_per_run = 49  # use perfect square (eg. 49 for 7*7 tiles)
+    band_rows: int = 8,
+    processes: Optional[int] = None,
+    path_memmap: Optional[str] = None,
+) -> int:
+    """Save the h, v and hv shifted tiles of a range of tiles
 
-n_tiles_x = n_tiles_y = int(np.sqrt(n_tiles_per_run))
+    The range is cut into bands of band_rows rows that are processed in a pool of
+    processes. Every source tile is decoded exactly once: the vertical shifts across
+    two bands are made from the half rows the band workers return.
 
-# number of runs on x-dim
-n_runs_x = int(np.ceil((tile_x_last - tile_x_first) / n_tiles_x))
-# number of runs on y-dim
-n_runs_y = int(np.ceil((tile_y_last - tile_y_first) / n_tiles_y))
-
-# h: horizontal, v:vertical, hv: both
-shifts_types = ["h", "v", "hv"]
-
-for run_x in range(n_runs_x):
-    tile_x_first_tmp = tile_x_first + (run_x * n_tiles_x)
-    if run_x != n_runs_x - 1:
-        # add "+1" row so that we can create space to shift last tiles
-        tile_x_last_tmp = tile_x_first + ((run_x + 1) * n_tiles_x) + 1
-    else:
-        # because the last badge might not be smaller than defined one
-        tile_x_last_tmp = tile_x_last
-    for run_y in range(n_runs_y):
-        tile_y_first_tmp = tile_y_first + (run_y * n_tiles_y)
-        if run_y != n_runs_y - 1:
-            # add "+1" so that we can create space to shift last tiles
-            tile_y_last_tmp = tile_y_first + ((run_y + 1) * n_tiles_y) + 1
-        else:
-            tile_y_last_tmp = tile_y_last
-        print(
-            f"For run_x {run_x} and run_y {run_y}:",
-            f"tiles_x: {tile_x_first_tmp},{tile_x_last_tmp}",
-            f"tiles_y: {tile_y_first_tmp}, {tile_y_last_tmp}",
-        )
-
-        # 1. LOAD TILES AND MERGE THEM
-
-        tiles_merged, tiles_unmerged, width_tile = load_merge_tiles(
-            foldername_tiles,
-            tile_x_first_tmp,
-            tile_x_last_tmp,
-            tile_y_first_tmp,
-            tile_y_last_tmp,
-        )
+    Returns:
+        int: number of saved tiles
+    """
+    width_tile = find_tile_width(
+        path_tiles_folder, tile_x_first, tile_x_last, tile_y_first, tile_y_last
+    )
+    bands = [
+        (tilex, min(tilex + band_rows, tile_x_last))
+        for tilex in range(tile_x_first, tile_x_last, band_rows)
+    ]
+    worker = partial(
+        shift_band, path_tiles_folder, width_tile, tile_y_first, tile_y_last, path_memmap
+    )
 
-        # Inspect bound tiles
-        # plot_single_image(tiles_merged)
-        # plot_multiple_images(tiles_unmerged, (100, 150))
-
-        # 2. SHIFTING MAP TILES
-
-        # Note:
-        # - In horizontal shift we loose 1 column of tiles
-        # - In vertical shift we loose i row of tiles
-        # - in v & h we loose 1 column and 1 row
-
-        # Shift tiles for every shift type
-        for shift in shifts_types:
-            xdim_orig, y_dim_orig, _ = tiles_merged.shape
-            if shift == "h":
-                tyle_x_range = [0, xdim_orig]
-                tyle_y_range = [width_tile // 2, -width_tile // 2]
-                xdim_diff_from_orig = 0
-                ydim_diff_from_orig = -1
-            elif shift == "v":
-                tyle_x_range = [width_tile // 2, -width_tile // 2]
-                tyle_y_range = [0, y_dim_orig]
-                xdim_diff_from_orig = -1
-                ydim_diff_from_orig = 0
-            elif shift == "hv":
-                tyle_x_range = [width_tile // 2, -width_tile // 2]
-                tyle_y_range = [width_tile // 2, -width_tile // 2]
-                xdim_diff_from_orig = -1
-                ydim_diff_from_orig = -1
-
-            # Cut left-right edges by half the width of a tile
-            # tiles_merged_cut_leftright = tiles_merged[:, width_tile // 2 : -width_tile // 2, :]
-            tiles_merged_cut = tiles_merged[
-                tyle_x_range[0] : tyle_x_range[1], tyle_y_range[0] : tyle_y_range[1], :
-            ]
-
-            # Inspect
-            # plot_single_image(tiles_merged_cut) # should be shorter at y_edges in "h", x_edges in "v", and at both edges with "hv"
-
-            # Create square tiles with dims same as original tiles
-            tiles_shifted = create_square_tiles(tiles_merged_cut, width_tile)
-
-            # Check-point : check dimensions of shifted tiles
-            # print(tiles_shifted.shape)
-            assert (
-                tiles_shifted.shape[0] == tiles_unmerged.shape[0] + xdim_diff_from_orig
-            )
-            assert (
-                tiles_shifted.shape[1] == tiles_unmerged.shape[1] + ydim_diff_from_orig
-            )
-            assert tiles_shifted.shape[2] == width_tile
-            assert tiles_shifted.shape[3] == width_tile
-            # plot_multiple_images(tiles_shifted)  # inspect
-
-            # Save new tiles
-            # note: adjust last_tiles based on shift
-            save_shifted_tiles(
-                tiles_shifted=tiles_shifted,
-                path_tiles_folder=foldername_tiles,
-                str_to_attach=f"_shift_{shift}.png",
-                tile_x_first=tile_x_first_tmp,
-                tile_x_last=tile_x_last_tmp + xdim_diff_from_orig,
-                tile_y_first=tile_y_first_tmp,
-                tile_y_last=tile_y_last_tmp + ydim_diff_from_orig,
-            )
+    saved = 0
+    with multiprocessing.Pool(processes) as pool:
+        boundaries = []
+        previous = None
+        for band, (top, top_present, bottom, bottom_present, n_saved) in zip(
+            bands, pool.imap(worker, bands)
+        ):
+            saved += n_saved
+            if previous is not None:
+                strip = np.concatenate([previous[0], top])
+                boundaries.append(
+                    pool.apply_async(
+                        save_row_shifts,
+                        (strip, previous[1] & top_present, path_tiles_folder,
+                         band[0] - 1, tile_y_first, ("v", "hv")),
+                    )
+                )
+            previous = bottom, bottom_present
+            print(f"Rows {band[0]} to {band[1] - 1} done, {saved} tiles saved")
+        saved += sum(boundary.get() for boundary in boundaries)
+    return saved
+
+
+if __name__ == "__main__":
+
+    # Provide needed information
+
+    foldername_tiles = r"/home/geomi/gm/projects/dsr/portfolio_project/MapTilesDownloader/src/output/googlemaps_data/21"
+    # Define first and last tiles in both x and y dimensions
+    tile_y_first = 1125826
+    tile_y_last = 1125856
+    tile_x_first = 687247
+    tile_x_last = 687264
+
+    # Rows of tiles per task of the process pool. A worker only holds 1.5 rows
+    # of decoded tiles, so memory does not grow with the range
+    band_rows = 8
+    n_processes = None  # one per CPU
+    # Set to a folder to keep the decoded rows in memory-mapped files instead
+    path_memmap = None
+
+    # Note:
+    # - In horizontal shift we loose 1 column of tiles
+    # - In vertical shift we loose 1 row of tiles
+    # - in v & h we loose 1 column and 1 row
+    n_saved = shift_tiles(
+        foldername_tiles,
+        tile_x_first,
+        tile_x_last,
+        tile_y_first,
+        tile_y_last,
+        band_rows=band_rows,
+        processes=n_processes,
+        path_memmap=path_memmap,
+    )
+    print(f"Saved {n_saved} shifted tiles")
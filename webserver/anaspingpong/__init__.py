@@ -9,7 +9,47 @@ def create_app(test_config=None):
     app.config.from_mapping(
      #   SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'anaspingpong.sqlite'),
-        DATA_XML='data/tables.xml',
+        # idle database connections kept open for reuse
+        DATABASE_POOL_SIZE=8,
+        TILE_CACHE_DIR=os.path.join(app.instance_path, 'tiles'),
+        TILE_CACHE_MAX_BYTES=2 ** 30,
+        TILE_CACHE_MAX_AGE=30 * 24 * 3600,
+        TILE_FETCH_WORKERS=16,
+        TILE_FETCH_TIMEOUT=10,
+        TILE_FETCH_RETRIES=2,
+        TILE_FETCH_VERIFY_SSL=True,
+        MODEL_PATH=os.path.join(os.path.dirname(os.path.dirname(app.root_path)),
+                                'model', 'checkpoint_Fbeta_entire_model'),
+        # tile scores of other model versions are recomputed on demand
+        MODEL_VERSION='checkpoint_Fbeta_entire_model',
+        # 'keras' runs the SavedModel, 'tflite' an export made with
+        # flask export-tflite, checked with flask model-parity
+        INFERENCE_BACKEND='keras',
+        TFLITE_MODEL_PATH=os.path.join(app.instance_path,
+                                       'checkpoint_Fbeta_entire_model-float16.tflite'),
+        # interpreter threads, all cores if None
+        TFLITE_THREADS=None,
+        # first stage file of flask calibrate-cascade; tiles it prunes skip
+        # the model, no cascade if None
+        CASCADE_PATH=None,
+        # load the model and trace its graph in the background at startup
+        MODEL_WARMUP=False,
+        # tiles of concurrent scans are scored together in shared batches
+        INFERENCE_MAX_BATCH=64,
+        INFERENCE_MAX_WAIT=0.01,
+        # 'tiles' scores every tile, 'mosaic' also scores the half-tile
+        # shifted views cut from the stitched neighbourhood
+        INFERENCE_MODE='tiles',
+        # adjacent positive tiles are one table, placed at their centroid
+        # weighted by probability, or unweighted
+        DETECTION_WEIGHTED=True,
+        # detections this close in meters to a stored table are that table
+        TABLE_MERGE_RADIUS=25,
+        JOB_WORKERS=2,
+        MARKER_TILE_CACHE_SIZE=4096,
+        # seconds browsers and CDNs may use a marker tile without revalidating
+        MARKER_TILE_MAX_AGE=60,
+        JOB_HISTORY=1000,
     )
 
     if test_config is None:
@@ -27,13 +67,47 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from . import metrics
+    metrics.init_app(app)
+
     from . import db
     db.init_app(app)
 
-    from . import prediction
+    from . import tilecache
+    tilecache.init_app(app)
+
+    from . import fetcher
+    fetcher.init_app(app)
+
+    from . import model
+    model.init_app(app)
+
+    from . import tflite
+    tflite.init_app(app)
+
+    from . import cascade
+    cascade.init_app(app)
+
+    from . import batcher
+    batcher.init_app(app)
+
+    from . import mosaic
+    mosaic.init_app(app)
+
+    from . import jobs
+    jobs.init_app(app)
 
     from . import load
     app.register_blueprint(load.bp)
     app.add_url_rule('/', endpoint='index')
 
+    from . import markers
+    markers.init_app(app)
+
+    from . import region
+    region.init_app(app)
+
+    from . import benchmark
+    benchmark.init_app(app)
+
     return app
@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+from flask import current_app
+
+from anaspingpong import metrics
+
+BATCH_SIZE = metrics.histogram('anaspingpong_inference_batch_size',
+                               'Images per model batch.',
+                               buckets=metrics.SIZE_BUCKETS)
+INFERENCE_SECONDS = metrics.histogram('anaspingpong_inference_seconds',
+                                      'Time the model takes for one batch.')
+PREDICT_SECONDS = metrics.histogram('anaspingpong_predict_seconds',
+                                    'Time from queueing images to their scores.')
+
+
+class InferenceBatcher:
+    """ Collect images from concurrent callers into shared model batches.
+
+    A single worker thread takes queued requests until max_batch_size images
+    are collected or max_wait seconds passed since the first one, runs the
+    model once on the combined batch and hands every caller its slice of the
+    probabilities.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait=0.01, history=1000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = 0
+        self.batches = 0
+        self.images = 0
+        self._latencies = deque(maxlen=history)
+        self._fills = deque(maxlen=history)
+        self._queue = queue.Queue()
+        self._carry = None
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def predict(self, images):
+        """ Return the model output for a uint8 batch, blocking until scored. """
+        start = time.perf_counter()
+        futures = []
+        # requests larger than a batch are split so they can share batches too
+        for i in range(0, len(images), self.max_batch_size):
+            future = Future()
+            self._queue.put((images[i:i + self.max_batch_size], future))
+            futures.append(future)
+        self._ensure_worker()
+        result = np.concatenate([future.result() for future in futures])
+        latency = time.perf_counter() - start
+        PREDICT_SECONDS.observe(latency)
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+        return result
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True,
+                                                name='inference-batcher')
+                self._worker.start()
+
+    def _collect(self):
+        if self._carry is not None:
+            pending = [self._carry]
+            self._carry = None
+        else:
+            pending = [self._queue.get()]
+        size = len(pending[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                images, future = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(images) > self.max_batch_size:
+                # does not fit anymore, start the next batch with it
+                self._carry = (images, future)
+                break
+            pending.append((images, future))
+            size += len(images)
+        return pending, size
+
+    def _run(self):
+        while True:
+            pending, size = self._collect()
+            BATCH_SIZE.observe(size)
+            try:
+                with INFERENCE_SECONDS.time():
+                    output = self.predict_fn(
+                        np.concatenate([images for images, _ in pending]))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for images, future in pending:
+                future.set_result(output[start:start + len(images)])
+                start += len(images)
+            with self._lock:
+                self.batches += 1
+                self.images += size
+                self._fills.append(size / self.max_batch_size)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'requests': self.requests,
+                'batches': self.batches,
+                'images': self.images,
+                'batch_fill': float(np.mean(self._fills)) if self._fills else None,
+                'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+                'latency_p95': latencies[int(len(latencies) * .95)] if latencies else None,
+            }
+
+
+def get_batcher():
+    return current_app.extensions['batcher']
+
+
+def init_app(app):
+    from anaspingpong.prediction import encode
+    registry = app.extensions['model']
+    app.extensions['batcher'] = InferenceBatcher(
+        lambda batch: registry.predict(encode(batch), batch_size=len(batch)),
+        max_batch_size=app.config['INFERENCE_MAX_BATCH'],
+        max_wait=app.config['INFERENCE_MAX_WAIT'],
+    )
@@ -0,0 +1,249 @@
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from PIL import Image
+
+from anaspingpong import geo
+from anaspingpong.db import connect, init_db, insert_tables, transaction
+from anaspingpong.fetcher import TileFetcher
+from anaspingpong.markers import gzip_chunks, json_chunks
+from anaspingpong.model import get_model
+from anaspingpong.prediction import IMAGE_SIZE, decode_tiles, encode
+from anaspingpong.utils import Utils
+
+# a slower median than this times the baseline counts as a regression
+REGRESSION_RATIO = 1.2
+
+
+class Benchmarks:
+    """ Time the stages of the prediction pipeline on synthetic data.
+
+    Every benchmark runs a function repeat times on the same input and
+    records the timings with the number of items one run handles, so results
+    of different machines and commits can be compared per item.
+    """
+
+    def __init__(self, repeat=5):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, items, fn, *args):
+        fn(*args)  # warm caches and lazy imports outside the timings
+        timings = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            fn(*args)
+            timings.append(time.perf_counter() - start)
+        median = statistics.median(timings)
+        self.results[name] = {
+            'items': items,
+            'repeat': self.repeat,
+            'seconds_min': min(timings),
+            'seconds_median': median,
+            'seconds_max': max(timings),
+            'us_per_item': median / items * 1e6,
+        }
+        click.echo(f'{name:32} {median * 1e3:10.3f} ms  '
+                   f'{median / items * 1e6:10.3f} us/item')
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+        click.echo(f'{name:32} skipped: {reason}')
+
+
+def synthetic_tile(seed, size=256):
+    """ JPEG bytes of a noisy gradient, about as large as an aerial tile. """
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 160, size, dtype=np.float32)
+    pixels = gradient[None, :, None] + gradient[:, None, None] * .5
+    pixels = pixels + rng.normal(0, 30, (size, size, 3))
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class TileServer:
+    """ Serve one tile for every path on localhost, standing in for Bing. """
+
+    def __init__(self, tile):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in separate writes; with Nagle on, every
+            # keep-alive request would wait for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(tile)))
+                self.end_headers()
+                self.wfile.write(tile)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.source = f'http://127.0.0.1:{self.server.server_port}/{{z}}/{{x}}/{{y}}.jpeg'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_benchmarks(repeat, batch_sizes, with_model):
+    bench = Benchmarks(repeat)
+    rng = np.random.default_rng(0)
+    n = 10_000
+    lats = rng.uniform(47, 55, n)
+    lons = rng.uniform(6, 15, n)
+    xs, ys = geo.to_tiles(lats, lons, 20)
+
+    bench.run('quadkey.makeQuadKey', 1000, lambda: [
+        Utils.makeQuadKey(x, y, 20) for x, y in zip(xs[:1000].tolist(), ys[:1000].tolist())])
+    bench.run('quadkey.vectorized', n, geo.quadkeys, xs, ys, 20)
+    bench.run('coordinates.scalar', 1000, lambda: [
+        (Utils.long2tile(lon, 20), Utils.lat2tile(lat, 20))
+        for lat, lon in zip(lats[:1000], lons[:1000])])
+    bench.run('coordinates.vectorized', n, geo.to_tiles, lats, lons, 20)
+
+    tiles = [synthetic_tile(seed) for seed in range(64)]
+    images = [Image.open(io.BytesIO(tile)).convert('RGB') for tile in tiles[:4]]
+    bench.run('mergeQuadTile', 1, Utils.mergeQuadTile, images)
+
+    with TileServer(tiles[0]) as server, tempfile.TemporaryDirectory() as directory:
+        fetcher = TileFetcher(max_workers=current_app.config['TILE_FETCH_WORKERS'])
+        coords = [(x, y, 20) for x, y in zip(xs[:64].tolist(), ys[:64].tolist())]
+        bench.run('download.downloadFile', 8, lambda: [
+            Utils.downloadFile(server.source, os.path.join(directory, f'{i}.jpeg'), x, y, z)
+            for i, (x, y, z) in enumerate(coords[:8])])
+        bench.run('download.fetch_many', len(coords), fetcher.fetch_many,
+                  server.source, coords)
+        bench.run('download.scaled_4', 16, Utils.buildScaledTile,
+                  server.source, *coords[0][:2], 18, 4, fetcher)
+
+    by_tile = {(i, 0, 20): tile for i, tile in enumerate(tiles)}
+    bench.run('decode', len(tiles), decode_tiles, by_tile)
+    batch, _ = decode_tiles(by_tile)
+    bench.run('encode', len(batch), encode, batch)
+
+    if with_model:
+        registry = get_model()
+        try:
+            registry.get()
+        except (ImportError, OSError) as e:
+            bench.skip('predict', f'model not available: {e}')
+        else:
+            for size in batch_sizes:
+                images = encode(np.resize(batch, (size,) + IMAGE_SIZE + (3,)))
+                bench.run(f'predict.batch_{size}', size,
+                          registry.predict, images, size)
+    else:
+        bench.skip('predict', 'disabled')
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = connect(os.path.join(directory, 'benchmark.sqlite'))
+        init_db(db, seed=False)
+        offset = iter(range(1_000_000))
+
+        def insert():
+            # new rows every run, a shifted copy of the detections
+            shift = next(offset) * 1e-3
+            with transaction(db):
+                insert_tables(db, lats[:1000] + shift, lons[:1000],
+                              merge_radius=current_app.config['TABLE_MERGE_RADIUS'])
+
+        bench.run('db.insert_tables', 1000, insert)
+        db.close()
+
+    markers = [(lat, lon, 1) for lat, lon in zip(lats.tolist(), lons.tolist())]
+    bench.run('markers.json', n, lambda: ''.join(json_chunks(iter(markers))))
+    bench.run('markers.json_gzip', n,
+              lambda: b''.join(gzip_chunks(json_chunks(iter(markers)))))
+    return bench.results
+
+
+def describe_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, baseline):
+    """ Echo the change against a baseline, return the regressed benchmarks. """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if 'skipped' in result or not before or 'skipped' in before:
+            continue
+        ratio = result['us_per_item'] / before['us_per_item']
+        flag = ''
+        if ratio > REGRESSION_RATIO:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        click.echo(f'{name:32} {before["us_per_item"]:10.3f} -> '
+                   f'{result["us_per_item"]:10.3f} us/item  x{ratio:.2f}{flag}')
+    return regressions
+
+
+@click.command('benchmark')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Write the results as JSON to this file.')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False),
+              help='Compare with the JSON results of an earlier run.')
+@click.option('--repeat', default=5, show_default=True,
+              help='Timed runs per benchmark.')
+@click.option('--batch-size', 'batch_sizes', multiple=True, type=int,
+              default=(1, 8, 32, 64), show_default=True,
+              help='Model batch sizes to time, repeatable.')
+@click.option('--model/--no-model', 'with_model', default=True, show_default=True,
+              help='Time the model, which needs TensorFlow.')
+@with_appcontext
+def benchmark_command(output, baseline_path, repeat, batch_sizes, with_model):
+    """Time the stages of the prediction pipeline offline."""
+    results = run_benchmarks(repeat, batch_sizes, with_model)
+    report = {'environment': describe_environment(), 'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        click.echo(f'Wrote the results to {output}.')
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        click.echo(f'Compared with {baseline["environment"]["commit"]}:')
+        regressions = compare(results, baseline['results'])
+        if regressions:
+            raise click.ClickException(f'{len(regressions)} benchmarks regressed: '
+                                       + ', '.join(regressions))
+
+
+def init_app(app):
+    app.cli.add_command(benchmark_command)
@@ -0,0 +1,231 @@
+""" Optional first stage that prunes clearly empty tiles before the model.
+
+The first stage runs the early layers of the model's backbone on tiles
+downsampled to a fraction of IMAGE_SIZE, averages the feature map and
+applies a logistic regression trained on the positive and negative sample
+folders. Its threshold is calibrated for a target recall, so only tiles
+that almost certainly hold no table are dropped; the others go to the full
+model.
+"""
+import os
+import threading
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+
+from anaspingpong import metrics
+
+CASCADE_TILES = metrics.counter('anaspingpong_cascade_tiles',
+                                'Tiles pruned by the cascade or passed on.',
+                                labels=('result',))
+
+
+def downsample(batch, size):
+    """ Average pool a uint8 (N, H, W, 3) batch down to (N, size, size, 3). """
+    factor = batch.shape[1] // size
+    if factor * size != batch.shape[1] or batch.shape[1] != batch.shape[2]:
+        raise ValueError(f'can not downsample {batch.shape[1:3]} tiles to {size}')
+    pooled = batch.reshape(len(batch), size, factor, size, factor, 3)
+    return pooled.mean(axis=(2, 4), dtype=np.float32)
+
+
+def default_layer(backbone):
+    # the deepest layer still at 1/8 of the input resolution
+    height = backbone.input_shape[1]
+    layers = [layer for layer in backbone.layers
+              if len(layer.output_shape) == 4 and layer.output_shape[1] * 8 >= height]
+    return layers[-1].name
+
+
+class FeatureExtractor:
+    """ Pooled early backbone features of downsampled tiles. """
+
+    def __init__(self, registry, layer, size):
+        self.registry = registry
+        self.layer = layer
+        self.size = size
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._model is None:
+                import tensorflow as tf
+                backbone = self.registry.get().layers[0]
+                if self.layer is None:
+                    self.layer = default_layer(backbone)
+                self._model = tf.keras.Model(backbone.inputs,
+                                             backbone.get_layer(self.layer).output)
+        return self._model
+
+    def __call__(self, batch, batch_size=64):
+        model = self._get()
+        # the backbone is convolutional, smaller inputs give smaller maps
+        features = model.predict(downsample(batch, self.size),
+                                 batch_size=batch_size, verbose=0)
+        return features.mean(axis=(1, 2))
+
+
+class Cascade:
+    """ The calibrated first stage, loaded from a file of calibrate-cascade. """
+
+    def __init__(self, registry, path):
+        self.path = path
+        with np.load(path) as data:
+            self.weights = data['weights']
+            self.bias = float(data['bias'])
+            self.mean = data['mean']
+            self.std = data['std']
+            self.threshold = float(data['threshold'])
+            layer, size = str(data['layer']), int(data['size'])
+        self.features = FeatureExtractor(registry, layer, size)
+
+    def probabilities(self, batch):
+        features = (self.features(batch) - self.mean) / self.std
+        return logistic(features @ self.weights + self.bias)
+
+    def keep(self, batch):
+        """ The mask of the tiles of a uint8 batch that go to the full model. """
+        kept = self.probabilities(batch) >= self.threshold
+        CASCADE_TILES.inc(int(kept.sum()), result='passed')
+        CASCADE_TILES.inc(int((~kept).sum()), result='pruned')
+        return kept
+
+
+def logistic(values):
+    return 1 / (1 + np.exp(-np.clip(values, -50, 50)))
+
+
+def fit_logistic(features, labels, l2=1e-3, steps=2000, learning_rate=.1):
+    """ Fit weights and bias of a logistic regression by gradient descent.
+
+    Classes are weighted equally, the sample folders are not balanced.
+    """
+    weights = np.zeros(features.shape[1])
+    bias = 0.0
+    sample_weights = np.where(labels, .5 / labels.mean(), .5 / (1 - labels.mean()))
+    sample_weights = sample_weights / len(labels)
+    for _ in range(steps):
+        error = (logistic(features @ weights + bias) - labels) * sample_weights
+        weights -= learning_rate * (features.T @ error + l2 * weights)
+        bias -= learning_rate * error.sum()
+    return weights, bias
+
+
+def recall_threshold(probabilities, target_recall):
+    """ The highest threshold that keeps target_recall of the positives. """
+    ranked = np.sort(probabilities)[::-1]
+    index = int(np.ceil(target_recall * len(ranked))) - 1
+    return float(ranked[max(index, 0)])
+
+
+def stratified_folds(labels, folds, rng):
+    """ Assign every sample a fold, each fold with the same share of positives. """
+    fold = np.empty(len(labels), dtype=np.int64)
+    for label in (True, False):
+        indices = rng.permutation(np.flatnonzero(labels == label))
+        fold[indices] = np.arange(len(indices)) % folds
+    return fold
+
+
+def calibrate(features, labels, target_recall, holdout=.3, folds=5, seed=0):
+    """ Train the first stage, calibrate its threshold and evaluate it.
+
+    A stratified share of the samples is held out for the report. The
+    threshold is chosen on out-of-fold probabilities of the training
+    positives, as probabilities of samples the regression was fit on would
+    make it too optimistic.
+    """
+    rng = np.random.default_rng(seed)
+    test = stratified_folds(labels, int(round(1 / holdout)), rng) == 0
+    train = ~test
+
+    mean = features[train].mean(axis=0)
+    std = features[train].std(axis=0) + 1e-6
+    scaled = (features - mean) / std
+    fold = stratified_folds(labels[train], folds, rng)
+    out_of_fold = np.empty(train.sum())
+    for k in range(folds):
+        weights, bias = fit_logistic(scaled[train][fold != k], labels[train][fold != k])
+        out_of_fold[fold == k] = logistic(scaled[train][fold == k] @ weights + bias)
+    threshold = recall_threshold(out_of_fold[labels[train]], target_recall)
+    weights, bias = fit_logistic(scaled[train], labels[train])
+    probabilities = logistic(scaled @ weights + bias)
+
+    kept = probabilities[test] >= threshold
+    positives = labels[test]
+    report = {
+        'train_tiles': int(train.sum()),
+        'test_tiles': int(test.sum()),
+        'threshold': threshold,
+        'recall': float(kept[positives].mean()) if positives.any() else None,
+        'lost_positives': int((~kept & positives).sum()),
+        'negatives_pruned': float((~kept[~positives]).mean()) if (~positives).any() else None,
+        'prune_rate': float((~kept).mean()),
+    }
+    return {'weights': weights, 'bias': bias, 'mean': mean, 'std': std,
+            'threshold': threshold}, report
+
+
+def create_cascade(config, registry):
+    """ The Cascade of CASCADE_PATH, or None when the cascade is off. """
+    if not config['CASCADE_PATH']:
+        return None
+    from anaspingpong.model import ModelRegistry
+    if not isinstance(registry, ModelRegistry):
+        # the first stage needs the layers of the Keras model
+        registry = ModelRegistry(config['MODEL_PATH'], config['MODEL_VERSION'])
+    return Cascade(registry, config['CASCADE_PATH'])
+
+
+def get_cascade():
+    return current_app.extensions['cascade']
+
+
+@click.command('calibrate-cascade')
+@click.argument('positives', type=click.Path(exists=True, file_okay=False))
+@click.argument('negatives', type=click.Path(exists=True, file_okay=False))
+@click.option('--target-recall', default=.99, show_default=True,
+              help='Share of the positives the first stage must keep.')
+@click.option('--size', default=128, show_default=True,
+              help='Side length the tiles are downsampled to.')
+@click.option('--layer', help='Backbone layer to take the features of '
+                              '[default: the deepest at 1/8 resolution].')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Defaults to CASCADE_PATH, or cascade.npz in the instance folder.')
+@with_appcontext
+def calibrate_cascade_command(positives, negatives, target_recall, size, layer, output):
+    """Train the cascade's first stage on the sample folders and report it."""
+    from anaspingpong.model import ModelRegistry
+    from anaspingpong.prediction import decode_files
+    from anaspingpong.tflite import image_files
+
+    config = current_app.config
+    extractor = FeatureExtractor(
+        ModelRegistry(config['MODEL_PATH'], config['MODEL_VERSION']), layer, size)
+    features, labels = [], []
+    for folder, label in ((positives, True), (negatives, False)):
+        files = image_files(folder)
+        for i in range(0, len(files), 64):
+            batch, _ = decode_files(files[i:i + 64])
+            if len(batch):
+                features.append(extractor(batch))
+                labels.extend([label] * len(batch))
+    if not labels or all(labels) or not any(labels):
+        raise click.ClickException('Both folders need readable tiles.')
+
+    stage, report = calibrate(np.concatenate(features), np.array(labels), target_recall)
+    output = output or config['CASCADE_PATH'] or os.path.join(
+        current_app.instance_path, 'cascade.npz')
+    np.savez(output, layer=extractor.layer, size=size, **stage)
+    click.echo(f'Wrote the first stage on {extractor.layer} at {size}px to {output}.')
+    click.echo('On the held out tiles:')
+    for key, value in report.items():
+        click.echo(f'{key}: {value}')
+
+
+def init_app(app):
+    app.extensions['cascade'] = create_cascade(app.config, app.extensions['model'])
+    app.cli.add_command(calibrate_cascade_command)
@@ -1,17 +1,102 @@
+import math
+import queue
 import sqlite3
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
 
 import click
+import numpy as np
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+from anaspingpong import geo
+
+# zoom level of the tiles that key the tables table
+KEY_ZOOM = 20
+# markers are clustered up to this map zoom, over cells of a quarter tile
+CLUSTER_MAX_ZOOM = 16
+CLUSTER_CELL_BITS = 2
+EARTH_RADIUS = 6_371_000
+
+
+# WAL lets readers go on while a scan writes; a writer waits for the lock
+# instead of failing, and commits only sync the log at checkpoints
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 10000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16384',
+    'PRAGMA mmap_size = 268435456',
+)
+
+
+def connect(database):
+    db = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        # pooled connections move between request and job threads
+        check_same_thread=False,
+        cached_statements=256,
+    )
+    db.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    return db
+
+
+class ConnectionPool:
+    """ Keep up to size open connections to reuse across requests.
+
+    A connection is used by one app context at a time; on release open
+    transactions are rolled back, like closing the connection did.
+    """
+
+    def __init__(self, database, size=8):
+        self.database = database
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.database)
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+@contextmanager
+def transaction(db):
+    """ Run a batch of writes as one transaction, committed at the end.
+
+    The write lock is taken up front, so a batch never fails halfway on a
+    lock held by another writer, and rolled back if the batch raises.
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = current_app.extensions['db_pool'].acquire()
 
     return g.db
 
@@ -20,22 +105,209 @@ def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        current_app.extensions['db_pool'].release(db)
+
+def insert_tables(db, latitudes, longitudes, merge_radius=0):
+    """ Insert detections, ignoring those in a tile that already has one.
 
-def init_db():
-    db = get_db()
+    Detections within merge_radius meters of a stored table are taken to be
+    that table and are not inserted either.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if merge_radius > 0 and len(latitudes):
+        new = ~near_tables(db, latitudes, longitudes, merge_radius)
+        latitudes, longitudes = latitudes[new], longitudes[new]
+    xs, ys = geo.to_tiles(latitudes, longitudes, KEY_ZOOM)
+    db.executemany(
+        'INSERT OR IGNORE INTO tables (z, x, y, latitude, longitude)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        zip([KEY_ZOOM] * len(xs), xs.tolist(), ys.tolist(),
+            latitudes.tolist(), longitudes.tolist())
+    )
 
+def tables_in_bbox(db, south, west, north, east):
+    # the R*Tree stores 32 bit floats, the exact bounds are checked on tables
+    return db.execute(
+        'SELECT t.id, t.latitude, t.longitude FROM tables_index i'
+        ' JOIN tables t ON t.id = i.id'
+        ' WHERE i.max_lat >= ? AND i.min_lat <= ?'
+        ' AND i.max_lon >= ? AND i.min_lon <= ?'
+        ' AND t.latitude BETWEEN ? AND ? AND t.longitude BETWEEN ? AND ?',
+        (south, north, west, east, south, north, west, east)
+    )
+
+def tables_near(db, latitude, longitude, radius):
+    """ Return the tables within radius meters, closest first. """
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlon = dlat / max(math.cos(math.radians(latitude)), 1e-6)
+    candidates = tables_in_bbox(db, latitude - dlat, longitude - dlon,
+                                latitude + dlat, longitude + dlon)
+    found = []
+    for table in candidates:
+        distance = haversine(latitude, longitude,
+                             table['latitude'], table['longitude'])
+        if distance <= radius:
+            found.append((distance, table))
+    return [table for _, table in sorted(found, key=lambda item: item[0])]
+
+def near_tables(db, latitudes, longitudes, radius):
+    """ Whether a stored table is within radius meters, for arrays of points.
+
+    Candidates for all points come from one bounding box query.
+    """
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlon = dlat / max(math.cos(math.radians(np.abs(latitudes).max())), 1e-6)
+    candidates = np.array(
+        [(row['latitude'], row['longitude']) for row in tables_in_bbox(
+            db, latitudes.min() - dlat, longitudes.min() - dlon,
+            latitudes.max() + dlat, longitudes.max() + dlon)],
+        dtype=np.float64).reshape(-1, 2)
+    if not len(candidates):
+        return np.zeros(len(latitudes), dtype=bool)
+    distances = haversine(latitudes[:, None], longitudes[:, None],
+                          candidates[None, :, 0], candidates[None, :, 1])
+    return (distances <= radius).any(axis=1)
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Distance in meters between points, also for arrays. """
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = (np.sin((phi2 - phi1) / 2) ** 2
+         + np.cos(phi1) * np.cos(phi2)
+         * np.sin(np.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def clusters_in_bbox(db, zoom, south, west, north, east):
+    """ Return the marker clusters of a map zoom level within a bounding box. """
+    cell_zoom = zoom + CLUSTER_CELL_BITS
+    x_first, y_first = geo.to_tiles(north, west, cell_zoom)
+    x_last, y_last = geo.to_tiles(south, east, cell_zoom)
+    return db.execute(
+        'SELECT count, sum_lat / count AS latitude, sum_lon / count AS longitude'
+        ' FROM marker_clusters'
+        ' WHERE z = ? AND cx BETWEEN ? AND ? AND cy BETWEEN ? AND ?',
+        (zoom, int(x_first), int(x_last), int(y_first), int(y_last))
+    )
+
+def tables_in_tile(db, z, x, y):
+    # tables are keyed by tiles at KEY_ZOOM, a tile covers a range of them
+    shift = KEY_ZOOM - z
+    return db.execute(
+        'SELECT id, latitude, longitude FROM tables'
+        ' WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?',
+        (KEY_ZOOM, x << shift, ((x + 1) << shift) - 1,
+         y << shift, ((y + 1) << shift) - 1)
+    )
+
+def clusters_in_tile(db, z, x, y):
+    return db.execute(
+        'SELECT count, sum_lat / count AS latitude, sum_lon / count AS longitude'
+        ' FROM marker_clusters'
+        ' WHERE z = ? AND cx BETWEEN ? AND ? AND cy BETWEEN ? AND ?',
+        (z, x << CLUSTER_CELL_BITS, ((x + 1) << CLUSTER_CELL_BITS) - 1,
+         y << CLUSTER_CELL_BITS, ((y + 1) << CLUSTER_CELL_BITS) - 1)
+    )
+
+def tile_version(db, z, x, y):
+    row = db.execute(
+        'SELECT version FROM tile_versions WHERE z = ? AND x = ? AND y = ?',
+        (z, x, y)
+    ).fetchone()
+    return 0 if row is None else row['version']
+
+def rebuild_clusters(db):
+    db.execute('DELETE FROM cluster_zooms')
+    db.executemany(
+        'INSERT INTO cluster_zooms (z, cell_zoom) VALUES (?, ?)',
+        [(z, z + CLUSTER_CELL_BITS) for z in range(CLUSTER_MAX_ZOOM + 1)]
+    )
+    db.execute('DELETE FROM marker_clusters')
+    db.execute(
+        'INSERT INTO marker_clusters (z, cx, cy, count, sum_lat, sum_lon)'
+        ' SELECT c.z, t.x >> (t.z - c.cell_zoom) AS cx,'
+        ' t.y >> (t.z - c.cell_zoom) AS cy,'
+        ' COUNT(*), SUM(t.latitude), SUM(t.longitude)'
+        ' FROM tables t CROSS JOIN cluster_zooms c'
+        ' GROUP BY c.z, cx, cy'
+    )
+    db.commit()
+
+def migrate_legacy_tables(db):
+    """ Move a tables table keyed by the old lat * lon hash aside. """
+    columns = [row['name'] for row in db.execute('PRAGMA table_info(tables)')]
+    if 'hash' in columns:
+        db.execute('ALTER TABLE tables RENAME TO tables_legacy')
+        db.commit()
+
+def copy_legacy_tables(db):
+    """ Copy rows of a moved legacy table into the tile keyed tables table. """
+    legacy = db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tables_legacy'"
+    ).fetchone()
+    if legacy is None:
+        return 0
+    rows = db.execute('SELECT latitude, longitude FROM tables_legacy').fetchall()
+    insert_tables(db, [row['latitude'] for row in rows],
+                  [row['longitude'] for row in rows])
+    db.execute('DROP TABLE tables_legacy')
+    db.commit()
+    return len(rows)
+
+def seed_tables(db):
+    """ Insert the detections shipped in data/tables.xml. """
+    with current_app.open_resource('data/tables.xml') as f:
+        markers = ET.parse(f).getroot().iter('marker')
+        points = [(float(m.get('lat')), float(m.get('lng'))) for m in markers]
+    insert_tables(db, [lat for lat, _ in points], [lon for _, lon in points])
+    db.commit()
+    return len(points)
+
+def init_db(db=None, seed=True):
+    """ Create missing tables and migrate old ones.
+
+    A new database is seeded with the shipped detections unless seed is off.
+    Returns the numbers of migrated and of seeded tables.
+    """
+    if db is None:
+        db = get_db()
+
+    fresh = db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tables'"
+    ).fetchone() is None
+    # databases created before the tile keys have their rows copied over
+    migrate_legacy_tables(db)
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    db.execute('DELETE FROM tile_zooms')
+    db.executemany('INSERT INTO tile_zooms (z) VALUES (?)',
+                   [(z,) for z in range(KEY_ZOOM + 1)])
+    migrated = copy_legacy_tables(db)
+    seeded = seed_tables(db) if fresh and seed else 0
+    rebuild_clusters(db)
+    return migrated, seeded
 
 
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
-    """Clear the existing data and create new table."""
-    init_db()
+    """Create missing tables and migrate an existing database."""
+    migrated, seeded = init_db()
+    if migrated:
+        click.echo(f'Migrated {migrated} tables to tile keys.')
+    if seeded:
+        click.echo(f'Added {seeded} tables from data/tables.xml.')
     click.echo('Initialized the database.')
 
+@click.command('rebuild-clusters')
+@with_appcontext
+def rebuild_clusters_command():
+    """Recompute the marker clusters of all zoom levels."""
+    rebuild_clusters(get_db())
+    click.echo('Rebuilt the marker clusters.')
+
 def init_app(app):
+    app.extensions['db_pool'] = ConnectionPool(app.config['DATABASE'],
+                                               app.config['DATABASE_POOL_SIZE'])
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(rebuild_clusters_command)
\ No newline at end of file
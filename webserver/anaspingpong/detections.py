@@ -0,0 +1,61 @@
+""" Collapse blobs of adjacent positive tiles into single detections.
+
+One table usually makes several neighbouring tiles positive. The positive
+cells of a grid are grouped into 8-connected components and every component
+becomes one detection at its centroid, weighted by the cells' probabilities.
+"""
+import numpy as np
+
+from anaspingpong import geo
+
+
+def components(cells):
+    """ Group (col, row) grid cells into lists of 8-connected cells. """
+    remaining = set(cells)
+    groups = []
+    while remaining:
+        stack = [remaining.pop()]
+        group = []
+        while stack:
+            col, row = stack.pop()
+            group.append((col, row))
+            for dcol in (-1, 0, 1):
+                for drow in (-1, 0, 1):
+                    neighbour = (col + dcol, row + drow)
+                    if neighbour in remaining:
+                        remaining.remove(neighbour)
+                        stack.append(neighbour)
+        groups.append(group)
+    return groups
+
+
+def centroids(probabilities, threshold, weighted=True):
+    """ Return the (cols, rows) centroids of the blobs of cells above threshold.
+
+    probabilities maps (col, row) cells to probabilities. With weighted the
+    cells count by their probability, otherwise equally.
+    """
+    cells = [cell for cell, p in probabilities.items() if p > threshold]
+    cols, rows = [], []
+    for group in components(cells):
+        points = np.array(group, dtype=np.float64)
+        weights = (np.array([probabilities[cell] for cell in group])
+                   if weighted else None)
+        col, row = np.average(points, axis=0, weights=weights)
+        cols.append(col)
+        rows.append(row)
+    return np.array(cols), np.array(rows)
+
+
+def cluster_tiles(scores, threshold, weighted=True):
+    """ One (latitude, longitude) detection per blob of positive tiles.
+
+    scores maps (x, y, z) tiles of one zoom level to probabilities. Returns
+    arrays of the latitudes and longitudes of the blobs' centroids.
+    """
+    if not scores:
+        return np.array([]), np.array([])
+    z = next(iter(scores))[2]
+    xs, ys = centroids({(x, y): p for (x, y, _), p in scores.items()},
+                       threshold, weighted)
+    return geo.to_coordinates(xs, ys, z, anchor='centre')
@@ -0,0 +1,80 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from anaspingpong import metrics
+from anaspingpong.utils import Utils
+
+FETCH_SECONDS = metrics.histogram('anaspingpong_tile_fetch_seconds',
+                                  'Latency of tile downloads that got a response.')
+FETCHES = metrics.counter('anaspingpong_tile_fetches',
+                          'Tile downloads by status code, -1 if unreachable.',
+                          labels=('code',))
+
+
+class TileFetcher:
+    """ Download tiles concurrently over a pool of keep-alive connections.
+
+    Status codes follow Utils.downloadFile: 200 on success, the HTTP status
+    on an HTTP error and -1 when the server could not be reached.
+    """
+
+    def __init__(self, max_workers=16, timeout=10, retries=2, verify=True):
+        self.timeout = timeout
+        self.verify = verify
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max_workers,
+            max_retries=Retry(total=retries, backoff_factor=0.1,
+                              status_forcelist=(429, 500, 502, 503, 504),
+                              raise_on_status=False),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='tile-fetch')
+
+    def fetch(self, source, x, y, z):
+        """ Return (status code, tile bytes or None) for a single tile. """
+        url = Utils.qualifyURL(source, x, y, z)
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, timeout=self.timeout,
+                                        verify=self.verify)
+        except requests.RequestException as e:
+            print(e)
+            FETCHES.inc(code=-1)
+            return -1, None
+        FETCH_SECONDS.observe(time.perf_counter() - start)
+        FETCHES.inc(code=response.status_code)
+        if response.status_code != 200:
+            return response.status_code, None
+        return 200, response.content
+
+    def fetch_many(self, source, tiles):
+        """ Fetch (x, y, z) tiles in parallel, return {tile: (code, bytes)}. """
+        tiles = list(tiles)
+        results = self.executor.map(lambda tile: self.fetch(source, *tile), tiles)
+        return dict(zip(tiles, results))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+def get_tile_fetcher():
+    return current_app.extensions['tile_fetcher']
+
+
+def init_app(app):
+    app.extensions['tile_fetcher'] = TileFetcher(
+        max_workers=app.config['TILE_FETCH_WORKERS'],
+        timeout=app.config['TILE_FETCH_TIMEOUT'],
+        retries=app.config['TILE_FETCH_RETRIES'],
+        verify=app.config['TILE_FETCH_VERIFY_SSL'],
+    )
@@ -0,0 +1,91 @@
+""" Array conversions between WGS84 coordinates and Web Mercator tiles.
+
+All functions take scalars or NumPy arrays and broadcast like NumPy ufuncs.
+Tile coordinates point at a tile's top left corner; anchor='centre' moves a
+converted position to the middle of the tile instead, which is where the
+detections of a tile are placed.
+"""
+import numpy as np
+
+# latitudes beyond this are not covered by Web Mercator tiles
+MAX_LATITUDE = 85.0511287798
+
+ANCHORS = {'corner': 0.0, 'centre': 0.5}
+
+
+def _offset(anchor):
+    try:
+        return ANCHORS[anchor]
+    except KeyError:
+        raise ValueError(f'anchor must be one of {sorted(ANCHORS)}, not {anchor!r}')
+
+
+def lon_to_x(lon, zoom):
+    """ The x index of the tiles containing the longitudes. """
+    n = 2 ** zoom
+    x = np.floor((np.asarray(lon, dtype=np.float64) + 180) / 360 * n)
+    # 180 degrees east is the right edge of the last tile
+    return np.clip(x, 0, n - 1).astype(np.int64)
+
+
+def lat_to_y(lat, zoom):
+    """ The y index of the tiles containing the latitudes. """
+    n = 2 ** zoom
+    rad = np.radians(np.clip(np.asarray(lat, dtype=np.float64),
+                             -MAX_LATITUDE, MAX_LATITUDE))
+    y = np.floor((1 - np.arcsinh(np.tan(rad)) / np.pi) / 2 * n)
+    return np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def x_to_lon(x, zoom, anchor='corner'):
+    """ The longitude of tile x, which may be fractional, at the anchor. """
+    return (np.asarray(x, dtype=np.float64) + _offset(anchor)) / 2 ** zoom * 360 - 180
+
+
+def y_to_lat(y, zoom, anchor='corner'):
+    """ The latitude of tile y, which may be fractional, at the anchor. """
+    n = np.pi * (1 - 2 * (np.asarray(y, dtype=np.float64) + _offset(anchor)) / 2 ** zoom)
+    return np.degrees(np.arctan(np.sinh(n)))
+
+
+def to_tiles(lat, lon, zoom):
+    """ The (x, y) tile indices containing the coordinates. """
+    return lon_to_x(lon, zoom), lat_to_y(lat, zoom)
+
+
+def to_coordinates(x, y, zoom, anchor='corner'):
+    """ The (lat, lon) of tiles at the anchor. """
+    return y_to_lat(y, zoom, anchor), x_to_lon(x, zoom, anchor)
+
+
+def quadkeys(x, y, zoom):
+    """ Encode tiles of one zoom level as Bing quadkey strings.
+
+    Returns a str for scalar tiles and an array of str otherwise.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    x, y = np.broadcast_arrays(x, y)
+    # one quadkey digit per level, most significant bit first
+    shifts = np.arange(zoom - 1, -1, -1, dtype=np.int64)
+    digits = (((x[..., None] >> shifts) & 1)
+              | (((y[..., None] >> shifts) & 1) << 1)) + ord('0')
+    keys = np.ascontiguousarray(digits.astype(np.uint8)).view(f'S{max(zoom, 1)}')
+    keys = keys[..., 0].astype(str) if zoom else np.full(x.shape, '')
+    return str(keys) if keys.ndim == 0 else keys
+
+
+def from_quadkeys(keys):
+    """ Decode quadkeys of equal length into (x, y, zoom). """
+    keys = np.asarray(keys, dtype=str)
+    zoom = int(np.char.str_len(keys).max(initial=0))
+    if keys.size and (np.char.str_len(keys) != zoom).any():
+        raise ValueError('quadkeys must all have the same length')
+    digits = (np.frombuffer(keys.astype(f'S{max(zoom, 1)}').tobytes(), dtype=np.uint8)
+              .reshape(keys.shape + (max(zoom, 1),))[..., :zoom].astype(np.int64) - ord('0'))
+    if ((digits < 0) | (digits > 3)).any():
+        raise ValueError('quadkeys may only contain the digits 0 to 3')
+    weights = 1 << np.arange(zoom - 1, -1, -1, dtype=np.int64)
+    x = ((digits & 1) * weights).sum(axis=-1)
+    y = ((digits >> 1) * weights).sum(axis=-1)
+    return x, y, zoom
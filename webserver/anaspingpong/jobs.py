@@ -0,0 +1,111 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+
+class Job:
+
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = 'pending'
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        timings = {}
+        if self.started_at is not None:
+            timings['queued'] = self.started_at - self.submitted_at
+        if self.finished_at is not None:
+            timings['running'] = self.finished_at - self.started_at
+            timings['total'] = self.finished_at - self.submitted_at
+        return {
+            'id': self.id,
+            'status': self.status,
+            'timings': timings,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """ Run scans on a bounded worker pool inside the application context.
+
+    A job submitted while another one with the same key is pending or running
+    is not queued again, the existing job is returned instead. Finished jobs
+    are kept for lookup until max_history newer jobs have been submitted;
+    pending and running jobs are always kept.
+    """
+
+    def __init__(self, app, max_workers=2, max_history=1000):
+        self.app = app
+        self.max_history = max_history
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='scan-job')
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                return job
+            job = Job(key)
+            self._jobs[job.id] = job
+            self._active[key] = job
+            self._trim()
+        self.executor.submit(self._run, job, fn, args)
+        return job
+
+    def _trim(self):
+        # drop the oldest finished jobs, pending and running ones stay
+        excess = len(self._jobs) - self.max_history
+        stale = []
+        for job_id, job in self._jobs.items():
+            if len(stale) >= excess:
+                break
+            if self._active.get(job.key) is not job:
+                stale.append(job_id)
+        for job_id in stale:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args):
+        job.started_at = time.time()
+        job.status = 'running'
+        try:
+            with self.app.app_context():
+                job.result = fn(*args)
+            job.status = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._active.pop(job.key, None)
+
+
+def get_jobs():
+    return current_app.extensions['jobs']
+
+
+def init_app(app):
+    app.extensions['jobs'] = JobManager(
+        app,
+        max_workers=app.config['JOB_WORKERS'],
+        max_history=app.config['JOB_HISTORY'],
+    )
@@ -1,77 +1,90 @@
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, send_file, request, url_for
+    Blueprint, abort, jsonify, redirect, render_template, request, url_for
 )
 
 
-from anaspingpong.db import get_db
-from anaspingpong.prediction import get_tables
+from anaspingpong.db import get_db, insert_tables, transaction
+from anaspingpong.prediction import ZOOM, get_tables
+from anaspingpong.model import get_model
+from anaspingpong.batcher import get_batcher
+from anaspingpong.jobs import get_jobs
+from anaspingpong.metrics import STAGE_SECONDS
+from anaspingpong import geo
 from flask import current_app
 
 import re
-import os
 
 bp = Blueprint('load', __name__)
 
-def writeTablestoXML(tables, output_file):
-    with open(output_file, 'w') as output:
-        output.write('<?xml version="1.0" ?>\n')
-        output.write('<markers>\n')
-        for table in tables:
-            table_marker = f"  <marker " \
-                          f"lat=\"{table['latitude']}\" " \
-                          f"lng=\"{table['longitude']}\"/>\n"
-            output.write(table_marker)
-        output.write('</markers>\n')
-
 @bp.route('/')
 def index():
     return render_template('load/index.html',
                            key=current_app.config['GOOGLE_MAPS_KEY'])
 
-@bp.route('/data')
-def data():
-    return send_file(current_app.config['DATA_XML'])
+@bp.route('/health')
+def health():
+    return jsonify(status='ok', model=get_model().status(),
+                   inference=get_batcher().stats())
+
+
+def scan(center_lat, center_lon):
+    """ Find tables around a center point and store them, runs as a job. """
+    pred_lon, pred_lat = get_tables(center_lat, center_lon)
+
+    with STAGE_SECONDS.time(stage='table_store'), transaction(get_db()) as db:
+        insert_tables(db, pred_lat, pred_lon,
+                      merge_radius=current_app.config['TABLE_MERGE_RADIUS'])
+    return [{'latitude': lat, 'longitude': lon}
+            for lat, lon in zip(pred_lat, pred_lon)]
+
+
+def submit_scan(center_lat, center_lon):
+    # clicks on the same center tile share one job
+    x, y = geo.to_tiles(center_lat, center_lon, ZOOM)
+    key = (int(x), int(y), ZOOM)
+    return get_jobs().submit(key, scan, center_lat, center_lon)
 
 
 @bp.route('/predict', methods=('GET', 'POST'))
 def predict():
-    if request.method == 'POST':
-        center = request.form['location']
-        zoom = int(request.form['zoom'])
-        center = re.sub('[(),]', "", center).split()
-        error = None
-        center_lat = float(center[0])
-        center_lon = float(center[1])
-        hash_id = int(center_lat*center_lon*10_000)
-
-        pred_lon, pred_lat = get_tables(center_lat, center_lon)
-        hashes = [int(lat * lon * 10_000) for lat, lon in zip(pred_lat, pred_lon)]
-        print(pred_lon)
-        print(pred_lat)
-        print(hashes)
-
-        if error is not None:
-            flash(error)
-        else:
-            db = get_db()
-            for i in range(len(hashes)):
-                db.execute(
-                    'INSERT OR IGNORE INTO tables (hash, latitude, longitude)'
-                    ' VALUES (?, ?, ?)',
-                    (hashes[i], pred_lat[i], pred_lon[i])
-                )
-            db.commit()
-            tables = db.execute(
-                'SELECT latitude, longitude '
-                ' FROM tables'
-            ).fetchall()
-            writeTablestoXML(tables, os.path.join('anaspingpong',
-                                                  current_app.config['DATA_XML']))
-           # return redirect(url_for('load.index'))
+    if request.method == 'GET':
+        return redirect(url_for('load.index'))
+
+    center = request.form['location']
+    zoom = int(request.form['zoom'])
+    center = re.sub('[(),]', "", center).split()
+    center_lat = float(center[0])
+    center_lon = float(center[1])
+
+    job = submit_scan(center_lat, center_lon)
     return render_template('load/index.html',
                             key=current_app.config['GOOGLE_MAPS_KEY'],
                             center_lat=f'{center_lat:.6f}',
                             center_lon=f'{center_lon:.6f}',
-                            zoom=f'{zoom}')
+                            zoom=f'{zoom}',
+                            job_id=job.id)
+
+
+@bp.route('/jobs', methods=('POST',))
+def create_job():
+    values = request.get_json(silent=True) or request.form
+    try:
+        center_lat = float(values['latitude'])
+        center_lon = float(values['longitude'])
+    except (KeyError, TypeError, ValueError):
+        abort(400, 'latitude and longitude are required')
+
+    job = submit_scan(center_lat, center_lon)
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = url_for('load.job', job_id=job.id)
+    return response
+
 
+@bp.route('/jobs/<job_id>')
+def job(job_id):
+    job = get_jobs().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
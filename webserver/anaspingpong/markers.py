@@ -0,0 +1,256 @@
+import gzip
+import hashlib
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import timezone
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from anaspingpong import quadkey
+from anaspingpong.metrics import PAYLOAD_BYTES, counted_chunks
+from anaspingpong.db import (
+    CLUSTER_MAX_ZOOM, KEY_ZOOM, clusters_in_bbox, clusters_in_tile, connect,
+    get_db, tables_in_bbox, tables_in_tile, tile_version
+)
+
+bp = Blueprint('markers', __name__)
+
+
+class TilePayloadCache:
+    """ LRU cache of encoded marker tiles by integer quadkey and version.
+
+    A tile's version in the database changes only when a table inside it
+    changes, so entries of untouched tiles stay valid across inserts.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tile, version):
+        with self._lock:
+            entry = self._entries.get(tile)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(tile)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, tile, version, payload):
+        with self._lock:
+            self._entries[tile] = (version, payload)
+            self._entries.move_to_end(tile)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def tables_version(db):
+    row = db.execute(
+        'SELECT version, modified_at FROM tables_version WHERE id = 1'
+    ).fetchone()
+    return row['version'], row['modified_at'].replace(tzinfo=timezone.utc)
+
+
+def parse_bbox(value):
+    """ Parse 'south,west,north,east' into floats, abort with 400 if invalid. """
+    try:
+        south, west, north, east = (float(v) for v in value.split(','))
+    except (AttributeError, ValueError):
+        abort(400, 'bbox must be south,west,north,east')
+    if south > north:
+        abort(400, 'bbox south must not be north of north')
+    return south, west, north, east
+
+
+def bbox_ranges(south, west, north, east):
+    # a box crossing the antimeridian is queried as two boxes
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def iter_markers(database, bbox, zoom):
+    """ Yield (latitude, longitude, count) of the markers in a bounding box.
+
+    Up to CLUSTER_MAX_ZOOM nearby tables are merged into clusters; count is 1
+    for single tables.
+    """
+    # streamed after the request's connection is closed, so use its own
+    db = connect(database)
+    try:
+        for box in bbox_ranges(*bbox):
+            if zoom <= CLUSTER_MAX_ZOOM:
+                for row in clusters_in_bbox(db, max(zoom, 0), *box):
+                    yield row['latitude'], row['longitude'], row['count']
+            else:
+                for row in tables_in_bbox(db, *box):
+                    yield row['latitude'], row['longitude'], 1
+    finally:
+        db.close()
+
+
+def iter_all_markers(database):
+    db = connect(database)
+    try:
+        yield from db.execute('SELECT latitude, longitude FROM tables')
+    finally:
+        db.close()
+
+
+def json_chunks(markers):
+    # single tables as [lat, lng], clusters as [lat, lng, count]
+    yield '{"markers":['
+    yield from joined(f'[{lat:.6f},{lon:.6f}]' if count == 1
+                      else f'[{lat:.6f},{lon:.6f},{count}]'
+                      for lat, lon, count in markers)
+    yield ']}'
+
+
+def geojson_chunks(markers):
+    yield '{"type":"FeatureCollection","features":['
+    yield from joined(
+        f'{{"type":"Feature","properties":{{"count":{count}}},'
+        f'"geometry":{{"type":"Point","coordinates":[{lon:.6f},{lat:.6f}]}}}}'
+        for lat, lon, count in markers
+    )
+    yield ']}'
+
+
+def xml_chunks(rows):
+    yield '<?xml version="1.0" ?>\n<markers>\n'
+    yield from joined((f'  <marker lat="{row["latitude"]}" '
+                       f'lng="{row["longitude"]}"/>\n' for row in rows),
+                      separator='')
+    yield '</markers>\n'
+
+
+def joined(items, separator=',', size=500):
+    """ Join items with separator, yielding one string per size items. """
+    batch = []
+    first = True
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield ('' if first else separator) + separator.join(batch)
+            batch = []
+            first = False
+    if batch:
+        yield ('' if first else separator) + separator.join(batch)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_response(chunks, mimetype, etag, last_modified):
+    """ Stream chunks with validators, gzip encoded if the client accepts it.
+
+    Returns 304 without touching the chunks when the client's copy is fresh.
+    """
+    response = Response(mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = (request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since)
+    if fresh:
+        response.status_code = 304
+        return response
+
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        response.content_encoding = 'gzip'
+    response.response = counted_chunks(chunks, request.endpoint)
+    return response
+
+
+def tile_markers(db, z, x, y):
+    if z <= CLUSTER_MAX_ZOOM:
+        for row in clusters_in_tile(db, z, x, y):
+            yield row['latitude'], row['longitude'], row['count']
+    else:
+        for row in tables_in_tile(db, z, x, y):
+            yield row['latitude'], row['longitude'], 1
+
+
+@bp.route('/tiles/<int:z>/<int:x>/<int:y>')
+def tile(z, x, y):
+    """ The markers of one map tile, addressed like the imagery tiles. """
+    if z > KEY_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        abort(404)
+
+    db = get_db()
+    version = tile_version(db, z, x, y)
+    etag = f'{z}-{x}-{y}-{version}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cache = current_app.extensions['marker_tiles']
+        key = quadkey.encode(x, y, z)
+        payload = cache.get(key, version)
+        if payload is None:
+            data = ''.join(json_chunks(tile_markers(db, z, x, y))).encode('utf8')
+            payload = (data, gzip.compress(data))
+            cache.put(key, version, payload)
+        response = Response(mimetype='application/json')
+        if 'gzip' in request.accept_encodings:
+            response.set_data(payload[1])
+            response.content_encoding = 'gzip'
+        else:
+            response.set_data(payload[0])
+        PAYLOAD_BYTES.observe(response.content_length, endpoint=request.endpoint)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['MARKER_TILE_MAX_AGE']
+    return response
+
+
+@bp.route('/data')
+def data():
+    """ All markers as XML, the format of the former tables.xml file. """
+    db = get_db()
+    version, modified_at = tables_version(db)
+    rows = iter_all_markers(current_app.config['DATABASE'])
+    return stream_response(xml_chunks(rows), 'application/xml',
+                           f'{version}-xml', modified_at)
+
+
+@bp.route('/markers')
+def markers():
+    bbox = parse_bbox(request.args.get('bbox'))
+    zoom = request.args.get('zoom', 20, type=int)
+    geojson = request.args.get('format') == 'geojson'
+
+    db = get_db()
+    version, modified_at = tables_version(db)
+    key = json.dumps([bbox, zoom, geojson])
+    etag = f"{version}-{hashlib.sha1(key.encode('utf8')).hexdigest()[:16]}"
+
+    markers = iter_markers(current_app.config['DATABASE'], bbox, zoom)
+    if geojson:
+        return stream_response(geojson_chunks(markers), 'application/geo+json',
+                               etag, modified_at)
+    return stream_response(json_chunks(markers), 'application/json',
+                           etag, modified_at)
+
+
+def init_app(app):
+    app.extensions['marker_tiles'] = TilePayloadCache(
+        app.config['MARKER_TILE_CACHE_SIZE'])
+    app.register_blueprint(bp)
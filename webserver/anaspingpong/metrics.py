@@ -0,0 +1,189 @@
+""" Counters and histograms exposed in Prometheus text format at /metrics.
+
+Metrics are module level objects shared by all threads of a process.
+Recording a value takes a lock and a bisect, so instrumentation can stay on
+in production.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, g, request
+
+# seconds, from a cached tile read up to a slow download or model batch
+TIME_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+bp = Blueprint('metrics', __name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+    suffix = ''
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f'{self.name} takes the labels {self.labels}')
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        name = self.name + self.suffix
+        lines = [f'# HELP {name} {self.help}', f'# TYPE {name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+    suffix = '_total'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        yield f'{self.name}_total{_labels(self.labels, key)} {_number(value)}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per bucket counts, then the sum of all values
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key, counts):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = (('le', _number(bound)),)
+            yield f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}'
+        yield f'{self.name}_sum{_labels(self.labels, key)} {_number(counts[-1])}'
+        yield f'{self.name}_count{_labels(self.labels, key)} {cumulative}'
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # modules imported twice get the metric created first
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=TIME_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+STAGE_SECONDS = histogram('anaspingpong_stage_seconds',
+                          'Time spent in each stage of a table search.',
+                          labels=('stage',))
+REQUEST_SECONDS = histogram('anaspingpong_http_request_seconds',
+                            'Time to handle a request, without streaming.',
+                            labels=('endpoint',))
+RESPONSES = counter('anaspingpong_http_responses',
+                    'Responses by endpoint and status code.',
+                    labels=('endpoint', 'status'))
+PAYLOAD_BYTES = histogram('anaspingpong_marker_payload_bytes',
+                          'Size of marker responses as sent.',
+                          labels=('endpoint',), buckets=BYTE_BUCKETS)
+
+
+def counted_chunks(chunks, endpoint):
+    """ Pass chunks through, recording their total size when done. """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    PAYLOAD_BYTES.observe(size, endpoint=endpoint)
+
+
+@bp.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+def _record_request(response):
+    if 'request_start' in g:
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                endpoint=endpoint)
+        RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+
+def init_app(app):
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.register_blueprint(bp)
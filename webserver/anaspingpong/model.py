@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+class ModelRegistry:
+    """ Load the Keras model on first use and keep it for the process.
+
+    TensorFlow is only imported when the model is needed, so CLI commands and
+    health checks do not pay for it.
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def get(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    import tensorflow as tf
+                    model = tf.keras.models.load_model(self.path)
+                    self.load_seconds = time.perf_counter() - start
+                    print(f'Loaded model {self.version} in {self.load_seconds:.2f}s')
+                    self._model = model
+        return self._model
+
+    def predict(self, images_batch, batch_size):
+        return self.get().predict(images_batch, batch_size=batch_size, verbose=0)
+
+    def warmup(self, batch_size, image_size):
+        """ Load the model and trace its graph with a dummy batch. """
+        model = self.get()
+        start = time.perf_counter()
+        dummy = np.zeros((batch_size,) + tuple(image_size) + (3,), dtype=np.float32)
+        model.predict(dummy, batch_size=batch_size, verbose=0)
+        self.warmup_seconds = time.perf_counter() - start
+        print(f'Warmed up model {self.version} in {self.warmup_seconds:.2f}s')
+
+    def status(self):
+        return {
+            'version': self.version,
+            'backend': 'keras',
+            'loaded': self.loaded,
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': self.warmup_seconds,
+        }
+
+
+def model_version(config):
+    """ The version scores of the configured backend are stored under.
+
+    Scores of an export differ from the Keras model's, so each export file
+    and cascade gets its own version.
+    """
+    if config['INFERENCE_BACKEND'] == 'keras':
+        version = config['MODEL_VERSION']
+    else:
+        name = os.path.splitext(os.path.basename(config['TFLITE_MODEL_PATH']))[0]
+        version = f'tflite:{name}'
+    if config['CASCADE_PATH']:
+        # pruned tiles score 0, so a cascade changes the scores too
+        name = os.path.splitext(os.path.basename(config['CASCADE_PATH']))[0]
+        version += f'+cascade:{name}'
+    return version
+
+
+def create_model(config):
+    """ The model of the configured INFERENCE_BACKEND, loaded on first use. """
+    backend = config['INFERENCE_BACKEND']
+    if backend == 'keras':
+        return ModelRegistry(config['MODEL_PATH'], model_version(config))
+    if backend == 'tflite':
+        from anaspingpong.tflite import TFLiteModel
+        return TFLiteModel(config['TFLITE_MODEL_PATH'], model_version(config),
+                           config['TFLITE_THREADS'])
+    raise ValueError(f"INFERENCE_BACKEND must be 'keras' or 'tflite', not {backend!r}")
+
+
+def get_model():
+    return current_app.extensions['model']
+
+
+def warmup_model(registry, batch_size):
+    from anaspingpong.prediction import IMAGE_SIZE
+    registry.warmup(batch_size, IMAGE_SIZE)
+
+
+@click.command('warmup-model')
+@with_appcontext
+def warmup_model_command():
+    """Load the model, run a dummy batch and report the timings."""
+    registry = get_model()
+    warmup_model(registry, current_app.config['INFERENCE_MAX_BATCH'])
+    click.echo(f'Loaded in {registry.load_seconds:.2f}s, '
+               f'warmed up in {registry.warmup_seconds:.2f}s.')
+
+
+def init_app(app):
+    registry = create_model(app.config)
+    app.extensions['model'] = registry
+    app.cli.add_command(warmup_model_command)
+    if app.config['MODEL_WARMUP']:
+        # warm up in the background so the server starts accepting requests
+        threading.Thread(target=warmup_model,
+                         args=(registry, app.config['INFERENCE_MAX_BATCH']),
+                         daemon=True).start()
@@ -0,0 +1,82 @@
+import numpy as np
+from flask import current_app
+
+from anaspingpong.tiling import tile_grid, windows
+
+
+def stitch(batch, coords):
+    """ Stitch a batch of tiles into one mosaic image.
+
+    Returns the (rows * height, cols * width, 3) uint8 mosaic and the x, y of
+    its top left tile. Tiles missing from the batch stay black.
+    """
+    xs, ys = coords[:, 0], coords[:, 1]
+    x0, y0 = xs.min(), ys.min()
+    height, width = batch.shape[1:3]
+    rows = ys.max() - y0 + 1
+    cols = xs.max() - x0 + 1
+    if height != width:
+        raise ValueError(f'can not stitch {height}x{width} tiles')
+    mosaic = np.zeros((rows * height, cols * width, 3), dtype=np.uint8)
+    tile_grid(mosaic, height)[ys - y0, xs - x0] = batch
+    return mosaic, x0, y0
+
+
+def check_model(model, tile_size):
+    """ Raise ValueError unless the model scores single tile_size tiles.
+
+    Reads the input and output shapes of a Keras model or a TFLite
+    interpreter, so a model that does not fit the mosaic fails up front.
+    """
+    if hasattr(model, 'get_input_details'):
+        inputs = tuple(model.get_input_details()[0]['shape'][1:])
+        outputs = tuple(model.get_output_details()[0]['shape'][1:])
+    else:
+        inputs = tuple(model.input_shape[1:])
+        outputs = tuple(model.output_shape[1:])
+    if inputs != (tile_size, tile_size, 3) or outputs != (1,):
+        raise ValueError(f'a model of {inputs} -> {outputs} can not score '
+                         f'{tile_size}px windows')
+
+
+class MosaicScorer:
+    """ Score the tiles of a mosaic and their half-tile shifted views.
+
+    Every tile sized window at a half-tile stride is cut from the mosaic as
+    a view and scored by the full model, so a window scores the same as the
+    crop on its own. Aligned windows are the original tiles, the others the
+    horizontally, vertically and diagonally shifted views of shift_tiles.py.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._checked = False
+
+    def heatmap(self, mosaic, tile_size, predict, batch_size=64):
+        """ Return the (2 * rows - 1, 2 * cols - 1) probabilities of all windows.
+
+        Entry [i, j] scores the tile sized window whose top left corner is
+        i / 2 tiles down and j / 2 tiles right of the mosaic's corner.
+        predict takes a uint8 batch, the windows are copied into batches of
+        at most batch_size.
+        """
+        if not self._checked:
+            check_model(self.registry.get(), tile_size)
+            self._checked = True
+        if tile_size % 2:
+            raise ValueError(f'{tile_size}px tiles have no half-tile stride')
+        views = windows(mosaic, tile_size, tile_size // 2)
+        positions = list(np.ndindex(views.shape[:2]))
+        scores = np.empty(len(positions), dtype=np.float32)
+        for i in range(0, len(positions), batch_size):
+            batch = np.stack([views[p] for p in positions[i:i + batch_size]])
+            scores[i:i + len(batch)] = predict(batch)[:, 0]
+        return scores.reshape(views.shape[:2])
+
+
+def get_mosaic_scorer():
+    return current_app.extensions['mosaic']
+
+
+def init_app(app):
+    app.extensions['mosaic'] = MosaicScorer(app.extensions['model'])
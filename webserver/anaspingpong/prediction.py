@@ -1,79 +1,164 @@
-from anaspingpong.utils import Utils
-import os
-import tensorflow as tf
-from tensorflow.keras import models, layers
+from anaspingpong import geo, quadkey
+from anaspingpong.db import get_db, transaction
+from anaspingpong.detections import centroids, cluster_tiles
+from anaspingpong.scores import get_scores, put_scores
+from anaspingpong.tilecache import get_tile_cache
+from anaspingpong.fetcher import get_tile_fetcher
+from anaspingpong.batcher import get_batcher
+from anaspingpong.cascade import get_cascade
+from anaspingpong.model import get_model
+from anaspingpong.mosaic import get_mosaic_scorer, stitch
+from anaspingpong.metrics import STAGE_SECONDS
+import io
+from flask import current_app
 import numpy as np
+from PIL import Image
 
 EXTEND_TILES = 2
 ZOOM = 20
 SOURCE = "http://ecn.t0.tiles.virtualearth.net/tiles/a{quad}.jpeg?g=129&mkt=en&stl=H"
 #source = "https://mt0.google.com/vt?lyrs=h&x={x}&s=&y={y}&z={z}"
-MODEL = tf.keras.models.load_model('../model/checkpoint_Fbeta_entire_model/')
-BATCH_SIZE = 25
 IMAGE_SIZE = (512, 512)
 THRESHOLD = .5
 
-def get_dataset(data_dir):
-    dataset = tf.keras.utils.image_dataset_from_directory(
-        data_dir,
-        labels=None,
-        image_size=IMAGE_SIZE,
-        shuffle=False,
-        batch_size=BATCH_SIZE
-    )
-    return dataset
-
 def encode(images_batch):
-    """ Function to transform images """
-    images_batch = tf.image.convert_image_dtype(images_batch, dtype=tf.float32)
+    """ Function to transform images
+
+    The model rescales its input itself, so it expects pixel values in
+    [0, 255] as float32, like image_dataset_from_directory produced.
+    """
+    images_batch = images_batch.astype(np.float32)
     return images_batch
 
 
+def decode_files(paths):
+    """ Decode image files into one uint8 batch, like decode_tiles.
+
+    Returns the batch and the paths of its rows.
+    """
+    tiles = {}
+    for i, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            tiles[(i, 0, 0)] = f.read()
+    batch, coords = decode_tiles(tiles)
+    return batch, [paths[i] for i in coords[:, 0]]
+
+
+def decode_tiles(tiles):
+    """ Decode {(x, y, z): image bytes} into one uint8 batch.
+
+    Returns the (N, height, width, 3) batch and the (N, 3) array of x, y, z
+    coordinates of its rows. Tiles that can not be decoded are left out.
+    """
+    batch = np.empty((len(tiles),) + IMAGE_SIZE + (3,), dtype=np.uint8)
+    coords = np.empty((len(tiles), 3), dtype=np.int64)
+    n = 0
+    for tile, data in tiles.items():
+        try:
+            image = Image.open(io.BytesIO(data)).convert('RGB')
+        except (OSError, Image.DecompressionBombError) as e:
+            print(f'Could not decode tile {tile}: {e}')
+            continue
+        if image.size != IMAGE_SIZE[::-1]:
+            # tiles are upsampled the way image_dataset_from_directory did
+            image = image.resize(IMAGE_SIZE[::-1], Image.BILINEAR)
+        batch[n] = np.asarray(image)
+        coords[n] = tile
+        n += 1
+    return batch[:n], coords[:n]
+
+
 def get_tables(latitude, longitude):
-    # download center tile +- EXTEND_TILES in all directions
-    download_folder = download_tables(latitude, longitude)
-    print(download_folder)
+    # center tile +- EXTEND_TILES in all directions
+    tiles = neighbourhood_tiles(latitude, longitude)
+    if current_app.config['INFERENCE_MODE'] == 'mosaic':
+        return get_tables_mosaic(tiles)
+
+    # only download and score tiles this model has not scored yet
+    db = get_db()
+    model_version = get_model().version
+    with STAGE_SECONDS.time(stage='score_lookup'):
+        scores = get_scores(db, tiles, model_version)
+    missing = [tile for tile in tiles if tile not in scores]
+    if missing:
+        new_scores = score_tiles(download_tables(missing))
+        with STAGE_SECONDS.time(stage='score_store'), transaction(db):
+            put_scores(db, new_scores, model_version)
+        scores.update(new_scores)
 
-    # create tensorflow dataset
-    dataset = get_dataset(download_folder)
-    dataset_encode = dataset.map(lambda dataset: encode(dataset))
+    # one detection per blob of adjacent positive tiles
+    with STAGE_SECONDS.time(stage='cluster'):
+        latitudes, longitudes = cluster_tiles(
+            scores, THRESHOLD, current_app.config['DETECTION_WEIGHTED'])
+    return longitudes.tolist(), latitudes.tolist()
 
-    # predict probabilities
-    label_pred = MODEL.predict(dataset_encode)
 
-    # get images with positive prediction
-    keys_pos = np.where(label_pred > THRESHOLD)[0]
-    if len(keys_pos) == 0:
+def get_tables_mosaic(tiles):
+    """ Score the tiles and their half-tile shifted views.
+
+    Tables on tile borders are found by the shifted views. The window scores
+    are not recorded in the score store, most windows are not tiles.
+    """
+    tiles = download_tables(tiles)
+    with STAGE_SECONDS.time(stage='decode'):
+        batch, coords = decode_tiles(tiles)
+    if len(batch) == 0:
         return [], []
-    file_names = np.array(dataset.file_paths)
+    with STAGE_SECONDS.time(stage='inference'):
+        mosaic, x0, y0 = stitch(batch, coords)
+        batcher = get_batcher()
+        heatmap = get_mosaic_scorer().heatmap(mosaic, IMAGE_SIZE[0], batcher.predict,
+                                              batcher.max_batch_size)
+
+    # window [i, j] starts i/2 tiles below and j/2 tiles right of the corner,
+    # overlapping positive windows are one detection
+    cols, rows = centroids({(j, i): p for (i, j), p in np.ndenumerate(heatmap)},
+                           THRESHOLD, current_app.config['DETECTION_WEIGHTED'])
+    z = coords[0, 2]
+    latitudes, longitudes = geo.to_coordinates(x0 + cols / 2, y0 + rows / 2, z,
+                                               anchor='centre')
+    return longitudes.tolist(), latitudes.tolist()
 
-    positive_tiles = [os.path.basename(s.replace('.jpeg', '')) for s in file_names[keys_pos]]
-    print(positive_tiles)
-    positive_tiles = np.array([s.split('_') for s in positive_tiles])
 
-    # extract x, y, z from filename and convert to lon, lat
-    xs = positive_tiles[:, 0].astype(int)
-    ys = positive_tiles[:, 1].astype(int)
-    zooms = positive_tiles[:, 2].astype(int)
-    z = zooms[0]
-    longitudes = [Utils.tile2long(x, z) for x in xs]
-    latitudes = [Utils.tile2lat(y, z) for y in ys]
-    return longitudes, latitudes
+def score_tiles(tiles, predict=None, cascade=None):
+    """ Predict {(x, y, z): probability} for {(x, y, z): image bytes}.
 
+    predict maps a uint8 batch to model output, by default the shared
+    inference batcher of the app, which also provides the default cascade.
+    Tiles the cascade prunes are not predicted and score 0.
+    """
+    with STAGE_SECONDS.time(stage='decode'):
+        batch, coords = decode_tiles(tiles)
+    if len(batch) == 0:
+        return {}
+    if predict is None:
+        predict = get_batcher().predict
+        cascade = get_cascade()
+    probabilities = np.zeros(len(batch), dtype=np.float32)
+    kept = np.ones(len(batch), dtype=bool)
+    if cascade is not None:
+        with STAGE_SECONDS.time(stage='cascade'):
+            kept = cascade.keep(batch)
+    if kept.any():
+        with STAGE_SECONDS.time(stage='inference'):
+            probabilities[kept] = predict(batch[kept])[:, 0]
+    return {tuple(int(c) for c in tile): float(score)
+            for tile, score in zip(coords, probabilities)}
 
-def download_tables(latitude, longitude):
-    center_x = Utils.long2tile(longitude, ZOOM)
-    center_y = Utils.lat2tile(latitude, ZOOM)
+
+def neighbourhood_tiles(latitude, longitude):
+    center_x, center_y = (int(i) for i in geo.to_tiles(latitude, longitude, ZOOM))
     z = ZOOM
 
-    tempDirectory = os.path.join("temp", f'tmp{Utils.randomString()}')
-    os.makedirs(tempDirectory)
-    for i in range(-EXTEND_TILES, EXTEND_TILES+1):
-        for j in range(-EXTEND_TILES, EXTEND_TILES+1):
-            # take n tiles left and right, up and down of center tile
-            x = center_x + i
-            y = center_y + j
-            tempFile = f"{x}_{y}_{ZOOM}" + ".jpeg"
-            tempFilePath = os.path.join(tempDirectory, tempFile)
-            result = Utils.downloadFile(SOURCE, tempFilePath, x, y, z)
-    return tempDirectory
\ No newline at end of file
+    # take n tiles left and right, up and down of center tile
+    return [(center_x + i, center_y + j, z)
+            for i in range(-EXTEND_TILES, EXTEND_TILES+1)
+            for j in range(-EXTEND_TILES, EXTEND_TILES+1)]
+
+
+def download_tables(tiles):
+    # fetch in Z-order, neighbouring tiles after each other
+    tiles = sorted(tiles, key=lambda tile: quadkey.encode(*tile))
+    with STAGE_SECONDS.time(stage='download'):
+        results = get_tile_cache().fetch_many(SOURCE, tiles, get_tile_fetcher())
+    return {tile: data for tile, (code, data) in results.items() if code == 200}
@@ -0,0 +1,142 @@
+""" Integer quadkeys: tiles of all zoom levels as single 64 bit integers.
+
+The key of tile (x, y, z) is a leading 1 bit followed by the z digits of its
+Bing quadkey, two bits each, so it is the Morton code of x and y marked with
+its zoom. Keys of different zoom levels never collide, fit a signed 64 bit
+integer up to MAX_ZOOM and can be used directly as SQLite or dict keys.
+Sorting keys of one zoom level orders the tiles along the Z-order curve, so
+neighbouring tiles end up close together.
+
+Functions take ints or NumPy arrays; scalar input gives Python ints back.
+"""
+import numpy as np
+
+MAX_ZOOM = 30
+# quads of up to 4 ** _MAX_BLOCK_DEPTH tiles are enumerated in one go
+_MAX_BLOCK_DEPTH = 8
+
+_SPREAD = (
+    (16, 0x0000FFFF0000FFFF),
+    (8, 0x00FF00FF00FF00FF),
+    (4, 0x0F0F0F0F0F0F0F0F),
+    (2, 0x3333333333333333),
+    (1, 0x5555555555555555),
+)
+
+
+def _result(value):
+    return int(value) if np.ndim(value) == 0 else value
+
+
+def _spread(v):
+    # insert a zero bit above every bit of v
+    v = np.asarray(v, dtype=np.int64) & 0xFFFFFFFF
+    for shift, mask in _SPREAD:
+        v = (v | (v << shift)) & mask
+    return v
+
+
+def _compact(v):
+    # inverse of _spread, keep every second bit
+    v = np.asarray(v, dtype=np.int64) & 0x5555555555555555
+    for (shift, _), (_, mask) in zip(reversed(_SPREAD), reversed(_SPREAD[:-1])):
+        v = (v | (v >> shift)) & mask
+    return (v | (v >> 16)) & 0xFFFFFFFF
+
+
+def morton(x, y):
+    """ Interleave the bits of x and y, x in the lower bit of each pair. """
+    return _result(_spread(x) | (_spread(y) << 1))
+
+
+def encode(x, y, z):
+    """ The integer quadkeys of tiles x, y at zoom z. """
+    z = np.asarray(z, dtype=np.int64)
+    if np.any(z < 0) or np.any(z > MAX_ZOOM):
+        raise ValueError(f'zoom must be between 0 and {MAX_ZOOM}')
+    return _result((np.int64(1) << (2 * z)) | morton(x, y))
+
+
+def zoom(keys):
+    """ The zoom level of integer quadkeys. """
+    keys = np.asarray(keys, dtype=np.int64)
+    if np.any(keys < 1):
+        raise ValueError('integer quadkeys are positive')
+    z = np.zeros(keys.shape, dtype=np.int64)
+    for level in range(1, MAX_ZOOM + 1):
+        z += keys >= (np.int64(1) << (2 * level))
+    return _result(z)
+
+
+def decode(keys):
+    """ The (x, y, z) tiles of integer quadkeys. """
+    keys = np.asarray(keys, dtype=np.int64)
+    z = np.asarray(zoom(keys))
+    code = keys ^ (np.int64(1) << (2 * z))
+    return _result(_compact(code)), _result(_compact(code >> 1)), _result(z)
+
+
+def parent(keys, levels=1):
+    """ The keys of the tiles levels zoom levels up that contain the tiles. """
+    if np.any(np.asarray(zoom(keys)) < levels):
+        raise ValueError(f'tiles above zoom {levels} have no parent {levels} levels up')
+    return _result(np.asarray(keys, dtype=np.int64) >> (2 * levels))
+
+
+def children(key, levels=1):
+    """ The keys of the 4 ** levels tiles covering a tile, in Z-order. """
+    if zoom(key) + levels > MAX_ZOOM:
+        raise ValueError(f'children would be below zoom {MAX_ZOOM}')
+    first = int(key) << (2 * levels)
+    return np.arange(first, first + 4 ** levels, dtype=np.int64)
+
+
+def neighbours(key):
+    """ The keys of the up to 8 tiles around a tile.
+
+    Tiles wrap around the antimeridian; above the top and below the bottom
+    row there are no tiles.
+    """
+    x, y, z = decode(key)
+    n = 2 ** z
+    found = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if (dx or dy) and 0 <= y + dy < n:
+                found.append(encode((x + dx) % n, y + dy, z))
+    return np.unique(np.array(found, dtype=np.int64))
+
+
+def zorder_tiles(x_first, y_first, x_last, y_last, z):
+    """ Yield the (x, y, z) tiles of an inclusive range in Z-order.
+
+    Walks the quadtree from the top, skipping quads outside the range and
+    emitting quads inside it at once, so the range is never materialized.
+    """
+    if x_first > x_last or y_first > y_last:
+        return
+    # start at the smallest quad containing the range
+    level = 0
+    while (level < z and x_first >> (z - level - 1) == x_last >> (z - level - 1)
+           and y_first >> (z - level - 1) == y_last >> (z - level - 1)):
+        level += 1
+    stack = [(x_first >> (z - level), y_first >> (z - level), level)]
+    while stack:
+        qx, qy, level = stack.pop()
+        depth = z - level
+        left, top = qx << depth, qy << depth
+        right, bottom = left + (1 << depth) - 1, top + (1 << depth) - 1
+        if right < x_first or left > x_last or bottom < y_first or top > y_last:
+            continue
+        inside = (left >= x_first and right <= x_last
+                  and top >= y_first and bottom <= y_last)
+        if inside and depth <= _MAX_BLOCK_DEPTH:
+            first = morton(qx, qy) << (2 * depth)
+            codes = np.arange(first, first + (1 << (2 * depth)), dtype=np.int64)
+            xs = _compact(codes).tolist()
+            ys = _compact(codes >> 1).tolist()
+            yield from zip(xs, ys, [z] * len(xs))
+            continue
+        # children pushed in reverse so the first quadrant is visited first
+        for digit in (3, 2, 1, 0):
+            stack.append((2 * qx + (digit & 1), 2 * qy + (digit >> 1), level + 1))
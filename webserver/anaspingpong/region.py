@@ -0,0 +1,309 @@
+import collections
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
+import time
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from PIL import Image
+
+from anaspingpong import geo, quadkey
+from anaspingpong.cascade import create_cascade
+from anaspingpong.db import get_db, insert_tables, tables_in_bbox, transaction
+from anaspingpong.detections import cluster_tiles
+from anaspingpong.fetcher import TileFetcher, get_tile_fetcher
+from anaspingpong.model import create_model, model_version
+from anaspingpong.prediction import (
+    SOURCE, THRESHOLD, ZOOM, encode, score_tiles
+)
+from anaspingpong.scores import get_scores, put_scores
+from anaspingpong.tilecache import TileCache, get_tile_cache
+from anaspingpong.utils import Utils
+
+# per-process state of the scan workers, set up by _init_worker
+_worker = {}
+
+
+def region_size(south, west, north, east, zoom):
+    """ The number of tiles of zoom covering a bounding box. """
+    x_first, y_first = geo.to_tiles(north, west, zoom)
+    x_last, y_last = geo.to_tiles(south, east, zoom)
+    return int((x_last - x_first + 1) * (y_last - y_first + 1))
+
+
+def region_tiles(south, west, north, east, zoom):
+    """ Generate the (x, y, z) tiles covering a bounding box in Z-order.
+
+    Consecutive tiles, and so the tiles of a chunk, lie close together.
+    """
+    x_first, y_first = geo.to_tiles(north, west, zoom)
+    x_last, y_last = geo.to_tiles(south, east, zoom)
+    return quadkey.zorder_tiles(int(x_first), int(y_first),
+                                int(x_last), int(y_last), zoom)
+
+
+def chunked(tiles, size):
+    """ Cut an iterable of tiles into lists of at most size tiles. """
+    tiles = iter(tiles)
+    while True:
+        chunk = list(itertools.islice(tiles, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_space_score(image):
+    """ How much a coarse tile looks like open space with hard surface.
+
+    Parks and school yards mix vegetation with bright grey paving. The score
+    is the geometric mean of both shares, scaled to reach 1 at half and half;
+    roofs and roads without green, or woods without paving, score low.
+    """
+    rgb = np.asarray(image, dtype=np.float32) / 255
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    vegetation = 2 * green - red - blue > .08
+    value = rgb.max(axis=-1)
+    saturation = (value - rgb.min(axis=-1)) / (value + 1e-6)
+    paved = (saturation < .15) & (value > .35) & (value < .85)
+    return float(2 * np.sqrt(vegetation.mean() * paved.mean()))
+
+
+def coarse_to_fine_tiles(south, west, north, east, zoom, coarse_zoom, threshold,
+                         score=open_space_score):
+    """ The zoom tiles of a bounding box below coarse tiles that score high.
+
+    Tiles of coarse_zoom are fetched and scored first. Only children of the
+    tiles scoring at least threshold are fetched at the next level, down to
+    zoom, whose remaining tiles are returned in Z-order for the full model.
+    Coarse tiles that can not be fetched or decoded are kept. A lower
+    threshold finds more tables at the cost of more tiles.
+
+    Returns the tiles and {zoom level: number of tiles fetched} of the
+    coarse levels.
+    """
+    x_first, y_first = (int(v) for v in geo.to_tiles(north, west, zoom))
+    x_last, y_last = (int(v) for v in geo.to_tiles(south, east, zoom))
+
+    def inside(x, y, z):
+        shift = zoom - z
+        return (x_first >> shift <= x <= x_last >> shift
+                and y_first >> shift <= y <= y_last >> shift)
+
+    cache = get_tile_cache()
+    fetcher = get_tile_fetcher()
+    shift = zoom - coarse_zoom
+    level = list(quadkey.zorder_tiles(x_first >> shift, y_first >> shift,
+                                      x_last >> shift, y_last >> shift, coarse_zoom))
+    fetched = {}
+    for z in range(coarse_zoom, zoom):
+        results = cache.fetch_many(SOURCE, level, fetcher)
+        kept = []
+        for tile in level:
+            code, data = results.get(tile, (None, None))
+            try:
+                image = Image.open(io.BytesIO(data)).convert('RGB')
+            except (OSError, Image.DecompressionBombError):
+                image = None
+            if code != 200 or image is None or score(image) >= threshold:
+                kept.append(tile)
+        fetched[z] = len(level)
+        level = [child for tile in kept for child in Utils.getChildTiles(*tile)
+                 if inside(*child)]
+    level.sort(key=lambda tile: quadkey.encode(*tile))
+    return level, fetched
+
+
+def coarse_recall(db, tiles, south, west, north, east, zoom):
+    """ Share of the stored tables of a bounding box on the given tiles.
+
+    An estimate of the recall of a coarse-to-fine search on regions where
+    tables are already known. None when there are none.
+    """
+    tables = tables_in_bbox(db, south, west, north, east).fetchall()
+    if not tables:
+        return None
+    xs, ys = geo.to_tiles(np.array([row['latitude'] for row in tables]),
+                          np.array([row['longitude'] for row in tables]), zoom)
+    kept = set(tiles)
+    return sum((x, y, zoom) in kept for x, y in zip(xs.tolist(), ys.tolist())) / len(tables)
+
+
+def _init_worker(config):
+    _worker['cache'] = TileCache(config['TILE_CACHE_DIR'],
+                                 max_bytes=config['TILE_CACHE_MAX_BYTES'],
+                                 max_age=config['TILE_CACHE_MAX_AGE'])
+    _worker['fetcher'] = TileFetcher(max_workers=config['TILE_FETCH_WORKERS'],
+                                     timeout=config['TILE_FETCH_TIMEOUT'],
+                                     retries=config['TILE_FETCH_RETRIES'],
+                                     verify=config['TILE_FETCH_VERIFY_SSL'])
+    _worker['model'] = create_model(config)
+    _worker['cascade'] = create_cascade(config, _worker['model'])
+    _worker['batch_size'] = config['INFERENCE_MAX_BATCH']
+
+
+def _predict(batch):
+    return _worker['model'].predict(encode(batch), batch_size=_worker['batch_size'])
+
+
+def _score_chunk(tiles):
+    """ Download, decode and score a chunk of tiles in a worker process.
+
+    Returns the scores and the tiles that could not be downloaded or decoded.
+    """
+    if not tiles:
+        return {}, []
+    results = _worker['cache'].fetch_many(SOURCE, tiles, _worker['fetcher'])
+    images = {tile: data for tile, (code, data) in results.items() if code == 200}
+    scores = score_tiles(images, predict=_predict, cascade=_worker['cascade'])
+    return scores, [tile for tile in tiles if tile not in scores]
+
+
+def scan_region(south, west, north, east, zoom, processes, chunk_size,
+                coarse_zoom=None, coarse_threshold=.1):
+    """ Score every tile of a bounding box and store the detected tables.
+
+    Chunks of tiles are scored in worker processes, each with its own model,
+    and committed in order together with the scan's checkpoint, so running
+    the same scan again continues after the last committed chunk. Tiles the
+    current model already scored are skipped. The checkpoint does not pass a
+    chunk with tiles that failed to download or decode, so running the scan
+    again retries them. With coarse_zoom only the tiles coarse_to_fine_tiles
+    keeps are scored, and the checkpoint only continues a scan of the same
+    tiles.
+    """
+    db = get_db()
+    version = model_version(current_app.config)
+    scan_id = f'{zoom}/{south}/{west}/{north}/{east}/{chunk_size}/zorder'
+    area = region_size(south, west, north, east, zoom)
+    if coarse_zoom is None:
+        tiles = region_tiles(south, west, north, east, zoom)
+        total = area
+    else:
+        tiles, fetched = coarse_to_fine_tiles(south, west, north, east, zoom,
+                                              coarse_zoom, coarse_threshold)
+        total = len(tiles)
+        # coarse tiles that failed to download are kept, so the tiles can
+        # differ between runs and the chunk checkpoint only holds for the
+        # same list; a new list starts over, skipping the tiles scored so far
+        digest = hashlib.sha1(' '.join(str(quadkey.encode(*tile)) for tile in tiles)
+                              .encode('utf8')).hexdigest()[:16]
+        scan_id += f'/coarse{coarse_zoom}@{coarse_threshold}/{digest}'
+        for z, count in fetched.items():
+            click.echo(f'zoom {z}: fetched {count} tiles')
+        click.echo(f'zoom {zoom}: {len(tiles)} of {area} tiles left, '
+                   f'{(sum(fetched.values()) + len(tiles)) / area:.3f} tiles fetched '
+                   f'per tile of the area')
+        recall = coarse_recall(db, tiles, south, west, north, east, zoom)
+        if recall is not None:
+            click.echo(f'{recall:.1%} of the stored tables of the area are on them')
+    total_chunks = -(-total // chunk_size)
+
+    db.execute(
+        'INSERT OR IGNORE INTO region_scans (id, total_chunks) VALUES (?, ?)',
+        (scan_id, total_chunks)
+    )
+    db.commit()
+    done = db.execute(
+        'SELECT done_chunks FROM region_scans WHERE id = ?', (scan_id,)
+    ).fetchone()['done_chunks']
+    click.echo(f'Scanning {total} tiles in {total_chunks} chunks, '
+               f'{done} chunks already done.')
+
+    # tiles are generated chunk by chunk as workers need them, already
+    # scored ones are looked up then
+    chunks = itertools.islice(chunked(tiles, chunk_size), done, None)
+
+    def todo(chunk):
+        scores = get_scores(db, chunk, version)
+        return [tile for tile in chunk if tile not in scores]
+
+    config = {key: current_app.config[key] for key in (
+        'TILE_CACHE_DIR', 'TILE_CACHE_MAX_BYTES', 'TILE_CACHE_MAX_AGE',
+        'TILE_FETCH_WORKERS', 'TILE_FETCH_TIMEOUT', 'TILE_FETCH_RETRIES',
+        'TILE_FETCH_VERIFY_SSL', 'MODEL_PATH', 'MODEL_VERSION',
+        'INFERENCE_BACKEND', 'TFLITE_MODEL_PATH', 'TFLITE_THREADS', 'CASCADE_PATH',
+        'INFERENCE_MAX_BATCH')}
+    weighted = current_app.config['DETECTION_WEIGHTED']
+    merge_radius = current_app.config['TABLE_MERGE_RADIUS']
+    start = time.perf_counter()
+    scored = 0
+    found = 0
+    failed = 0
+    failed_examples = []
+    checkpoint = done
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes, initializer=_init_worker, initargs=(config,)) as pool:
+        # a few chunks per worker in flight, results are taken in order
+        pending = collections.deque(
+            pool.apply_async(_score_chunk, (todo(chunk),))
+            for chunk in itertools.islice(chunks, 2 * processes))
+        index = done
+        while pending:
+            scores, missing = pending.popleft().get()
+            chunk = next(chunks, None)
+            if chunk is not None:
+                pending.append(pool.apply_async(_score_chunk, (todo(chunk),)))
+            # the checkpoint stops before the first chunk with failed tiles
+            if not missing and not failed:
+                checkpoint = index + 1
+            failed += len(missing)
+            failed_examples.extend(missing[:5 - len(failed_examples)])
+            # blobs cut by a chunk border are merged with the stored half
+            latitudes, longitudes = cluster_tiles(scores, THRESHOLD, weighted)
+            with transaction(db):
+                put_scores(db, scores, version)
+                insert_tables(db, latitudes, longitudes, merge_radius=merge_radius)
+                db.execute(
+                    'UPDATE region_scans SET done_chunks = ?,'
+                    ' updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                    (checkpoint, scan_id)
+                )
+
+            scored += len(scores)
+            found += len(latitudes)
+            elapsed = time.perf_counter() - start
+            click.echo(f'chunk {index + 1}/{total_chunks}: {scored} tiles scored, '
+                       f'{failed} failed, {scored / elapsed:.1f} tiles/s, '
+                       f'{found} tables found')
+            index += 1
+
+    if failed:
+        click.echo(f'{failed} tiles could not be downloaded or decoded, '
+                   f'e.g. {failed_examples}. Run the scan again to retry them.')
+    return found
+
+
+@click.command('scan-region')
+@click.argument('south', type=float)
+@click.argument('west', type=float)
+@click.argument('north', type=float)
+@click.argument('east', type=float)
+@click.option('--zoom', default=ZOOM, show_default=True)
+@click.option('--processes', default=os.cpu_count(), show_default=True,
+              help='Number of worker processes.')
+@click.option('--chunk-size', default=256, show_default=True,
+              help='Tiles per worker task and per checkpoint.')
+@click.option('--coarse-zoom', type=int,
+              help='Search from this zoom level down, skipping tiles below '
+                   'coarse tiles that do not look like open space.')
+@click.option('--coarse-threshold', default=.1, show_default=True,
+              help='Open space score a coarse tile needs to be refined; '
+                   'lower finds more tables and fetches more tiles.')
+@with_appcontext
+def scan_region_command(south, west, north, east, zoom, processes, chunk_size,
+                        coarse_zoom, coarse_threshold):
+    """Find tables in a bounding box, resuming an interrupted scan."""
+    if coarse_zoom is not None and not 0 < coarse_zoom < zoom:
+        raise click.BadParameter(f'must be between 0 and {zoom}', param_hint='--coarse-zoom')
+    found = scan_region(south, west, north, east, zoom, processes, chunk_size,
+                        coarse_zoom, coarse_threshold)
+    click.echo(f'Scan finished, {found} tables found.')
+
+
+def init_app(app):
+    app.cli.add_command(scan_region_command)
@@ -1,7 +1,193 @@
 --DROP TABLE IF EXISTS tables;
 
+-- tables are keyed by the zoom 20 tile they lie in
 CREATE TABLE IF NOT EXISTS tables (
-  hash INT PRIMARY KEY,
+  id INTEGER PRIMARY KEY,
+  z INT NOT NULL,
+  x INT NOT NULL,
+  y INT NOT NULL,
   latitude FLOAT NOT NULL,
-  longitude FLOAT NOT NULL
+  longitude FLOAT NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (z, x, y)
 );
+
+CREATE VIRTUAL TABLE IF NOT EXISTS tables_index USING rtree(
+  id,
+  min_lat, max_lat,
+  min_lon, max_lon
+);
+
+CREATE TRIGGER IF NOT EXISTS tables_index_insert AFTER INSERT ON tables
+BEGIN
+  INSERT INTO tables_index (id, min_lat, max_lat, min_lon, max_lon)
+  VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+END;
+
+CREATE TRIGGER IF NOT EXISTS tables_index_update
+AFTER UPDATE OF latitude, longitude ON tables
+BEGIN
+  UPDATE tables_index
+  SET min_lat = new.latitude, max_lat = new.latitude,
+      min_lon = new.longitude, max_lon = new.longitude
+  WHERE id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tables_index_delete AFTER DELETE ON tables
+BEGIN
+  DELETE FROM tables_index WHERE id = old.id;
+END;
+
+-- bumped on every change of tables, validates cached marker responses
+CREATE TABLE IF NOT EXISTS tables_version (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  version INT NOT NULL,
+  modified_at TIMESTAMP NOT NULL
+);
+
+INSERT OR IGNORE INTO tables_version (id, version, modified_at)
+VALUES (1, 0, CURRENT_TIMESTAMP);
+
+CREATE TRIGGER IF NOT EXISTS tables_version_insert AFTER INSERT ON tables
+BEGIN
+  UPDATE tables_version
+  SET version = version + 1, modified_at = CURRENT_TIMESTAMP WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tables_version_update AFTER UPDATE ON tables
+BEGIN
+  UPDATE tables_version
+  SET version = version + 1, modified_at = CURRENT_TIMESTAMP WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tables_version_delete AFTER DELETE ON tables
+BEGIN
+  UPDATE tables_version
+  SET version = version + 1, modified_at = CURRENT_TIMESTAMP WHERE id = 1;
+END;
+
+CREATE TABLE IF NOT EXISTS tile_scores (
+  z INT NOT NULL,
+  x INT NOT NULL,
+  y INT NOT NULL,
+  model_version TEXT NOT NULL,
+  probability FLOAT NOT NULL,
+  scored_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (z, x, y)
+);
+
+CREATE TABLE IF NOT EXISTS region_scans (
+  id TEXT PRIMARY KEY,
+  total_chunks INT NOT NULL,
+  done_chunks INT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- marker clusters per map zoom z over a grid of tiles at cell_zoom, kept up
+-- to date from the zoom 20 tile keys of tables by the triggers below
+CREATE TABLE IF NOT EXISTS cluster_zooms (
+  z INT PRIMARY KEY,
+  cell_zoom INT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS marker_clusters (
+  z INT NOT NULL,
+  cx INT NOT NULL,
+  cy INT NOT NULL,
+  count INT NOT NULL,
+  sum_lat FLOAT NOT NULL,
+  sum_lon FLOAT NOT NULL,
+  PRIMARY KEY (z, cx, cy)
+);
+
+CREATE TRIGGER IF NOT EXISTS clusters_insert AFTER INSERT ON tables
+BEGIN
+  INSERT INTO marker_clusters (z, cx, cy, count, sum_lat, sum_lon)
+  SELECT c.z, new.x >> (new.z - c.cell_zoom), new.y >> (new.z - c.cell_zoom),
+         1, new.latitude, new.longitude
+  FROM cluster_zooms c WHERE true
+  ON CONFLICT (z, cx, cy) DO UPDATE SET
+    count = count + 1,
+    sum_lat = sum_lat + excluded.sum_lat,
+    sum_lon = sum_lon + excluded.sum_lon;
+END;
+
+CREATE TRIGGER IF NOT EXISTS clusters_delete AFTER DELETE ON tables
+BEGIN
+  UPDATE marker_clusters SET
+    count = count - 1,
+    sum_lat = sum_lat - old.latitude,
+    sum_lon = sum_lon - old.longitude
+  WHERE (z, cx, cy) IN (
+    SELECT c.z, old.x >> (old.z - c.cell_zoom), old.y >> (old.z - c.cell_zoom)
+    FROM cluster_zooms c
+  );
+  DELETE FROM marker_clusters WHERE count <= 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS clusters_update
+AFTER UPDATE OF z, x, y, latitude, longitude ON tables
+BEGIN
+  UPDATE marker_clusters SET
+    count = count - 1,
+    sum_lat = sum_lat - old.latitude,
+    sum_lon = sum_lon - old.longitude
+  WHERE (z, cx, cy) IN (
+    SELECT c.z, old.x >> (old.z - c.cell_zoom), old.y >> (old.z - c.cell_zoom)
+    FROM cluster_zooms c
+  );
+  DELETE FROM marker_clusters WHERE count <= 0;
+  INSERT INTO marker_clusters (z, cx, cy, count, sum_lat, sum_lon)
+  SELECT c.z, new.x >> (new.z - c.cell_zoom), new.y >> (new.z - c.cell_zoom),
+         1, new.latitude, new.longitude
+  FROM cluster_zooms c WHERE true
+  ON CONFLICT (z, cx, cy) DO UPDATE SET
+    count = count + 1,
+    sum_lat = sum_lat + excluded.sum_lat,
+    sum_lon = sum_lon + excluded.sum_lon;
+END;
+
+-- version of every map tile up to the key zoom that holds a table, bumped
+-- when a table inside it changes so cached marker tiles are invalidated
+CREATE TABLE IF NOT EXISTS tile_zooms (
+  z INT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS tile_versions (
+  z INT NOT NULL,
+  x INT NOT NULL,
+  y INT NOT NULL,
+  version INT NOT NULL,
+  PRIMARY KEY (z, x, y)
+);
+
+CREATE TRIGGER IF NOT EXISTS tile_versions_insert AFTER INSERT ON tables
+BEGIN
+  INSERT INTO tile_versions (z, x, y, version)
+  SELECT t.z, new.x >> (new.z - t.z), new.y >> (new.z - t.z), 1
+  FROM tile_zooms t WHERE true
+  ON CONFLICT (z, x, y) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tile_versions_delete AFTER DELETE ON tables
+BEGIN
+  INSERT INTO tile_versions (z, x, y, version)
+  SELECT t.z, old.x >> (old.z - t.z), old.y >> (old.z - t.z), 1
+  FROM tile_zooms t WHERE true
+  ON CONFLICT (z, x, y) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tile_versions_update
+AFTER UPDATE OF z, x, y, latitude, longitude ON tables
+BEGIN
+  INSERT INTO tile_versions (z, x, y, version)
+  SELECT t.z, old.x >> (old.z - t.z), old.y >> (old.z - t.z), 1
+  FROM tile_zooms t WHERE true
+  ON CONFLICT (z, x, y) DO UPDATE SET version = version + 1;
+  INSERT INTO tile_versions (z, x, y, version)
+  SELECT t.z, new.x >> (new.z - t.z), new.y >> (new.z - t.z), 1
+  FROM tile_zooms t
+  WHERE (new.x >> (new.z - t.z)) != (old.x >> (old.z - t.z))
+     OR (new.y >> (new.z - t.z)) != (old.y >> (old.z - t.z))
+  ON CONFLICT (z, x, y) DO UPDATE SET version = version + 1;
+END;
@@ -0,0 +1,30 @@
+def get_scores(db, tiles, model_version):
+    """ Return {(x, y, z): probability} for the tiles scored by model_version. """
+    tiles = set(tiles)
+    if not tiles:
+        return {}
+    xs, ys, zs = zip(*tiles)
+    scores = {}
+    for z in set(zs):
+        # one range scan per zoom level over the primary key, filtered here
+        rows = db.execute(
+            'SELECT x, y, probability FROM tile_scores'
+            ' WHERE z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?'
+            ' AND model_version = ?',
+            (z, min(xs), max(xs), min(ys), max(ys), model_version)
+        ).fetchall()
+        for row in rows:
+            tile = (row['x'], row['y'], z)
+            if tile in tiles:
+                scores[tile] = row['probability']
+    return scores
+
+
+def put_scores(db, scores, model_version):
+    """ Record {(x, y, z): probability}, replacing scores of older models. """
+    db.executemany(
+        'INSERT OR REPLACE INTO tile_scores (z, x, y, model_version, probability)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        [(z, x, y, model_version, float(probability))
+         for (x, y, z), probability in scores.items()]
+    )
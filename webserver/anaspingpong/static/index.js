@@ -1,6 +1,9 @@
 let map;
 
-var data_xml = '/data'
+var tiles_url = '/tiles/'
+var max_tile_zoom = 20
+var shownMarkers = {}
+var shownZoom = null
 var newLat = 52.4907
 var newLng = 13.4726
 var zoom = 18;
@@ -51,6 +54,22 @@ function showAddress(address)
 
 }
 
+function placeCluster(location, count) {
+    return new google.maps.Marker({
+        position: location,
+        map: map,
+        label: String(count),
+        title: count + " ping pong tables"
+    });
+}
+
+function clearMarkers() {
+    $.each(shownMarkers, function(key, marker) {
+        marker.setMap(null);
+    });
+    shownMarkers = {}
+}
+
 function placeMarker(location) {
     var image = new google.maps.MarkerImage(
         'static/images/marker.png',
@@ -69,6 +88,7 @@ function placeMarker(location) {
         icon: image,
         title: "ping pong table"
     });
+    return pulseMarker;
   }
 
   
@@ -86,7 +106,8 @@ function initMap() {
         goHome();
     }
 
-   getPositions()
+   map.addListener('idle', getPositions)
+   pollJob()
 
  // var directionsService = new google.maps.DirectionsService();
  // var directionsRenderer = new google.maps.DirectionsRenderer();
@@ -115,27 +136,83 @@ function fillLocation() {
     document.forms[0].submit()
 }
 
-function getPositions() {
-    markerArray = new Array();
-    var jqxhr = $.get(data_xml, function(data) {
-
-          $(data).find("marker").each(function() {
-            var marker = jQuery(this);
-            var id = marker.attr("id");
-            var point = new google.maps.LatLng(parseFloat(marker.attr("lat")),
-                                        parseFloat(marker.attr("lng")));
-
-
-            markerArray.push(placeMarker(point));
-
-          });
+function pollJob() {
+    var jobId = document.getElementById('job_id').value
+    if (jobId == "") {
+        return;
+    }
+    $.getJSON('/jobs/' + jobId, function(job) {
+        if (job.status == 'pending' || job.status == 'running') {
+            document.getElementById('job_status').textContent = 'Searching for tables...'
+            setTimeout(pollJob, 1000);
+        } else if (job.status == 'done') {
+            document.getElementById('job_status').textContent = job.result.length + ' tables found'
+            getPositions(true)
+        } else {
+            document.getElementById('job_status').textContent = 'Search failed'
+        }
     });
 }
 
+function long2tile(lng, z) {
+    return Math.floor((lng + 180) / 360 * Math.pow(2, z));
+}
 
+function lat2tile(lat, z) {
+    var rad = lat * Math.PI / 180;
+    return Math.floor((1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2 * Math.pow(2, z));
+}
 
+function showTile(z, x, y, refresh) {
+    $.ajax({
+        url: tiles_url + z + '/' + x + '/' + y,
+        dataType: 'json',
+        // after a search the browser has to revalidate its cached tiles
+        headers: refresh ? {'Cache-Control': 'no-cache'} : {},
+        success: function(data) {
+            if (z != shownZoom) {
+                return;
+            }
+            $.each(data.markers, function(i, marker) {
+                var key = marker.join(',')
+                if (!(key in shownMarkers)) {
+                    var location = new google.maps.LatLng(marker[0], marker[1])
+                    if (marker.length > 2) {
+                        shownMarkers[key] = placeCluster(location, marker[2]);
+                    } else {
+                        shownMarkers[key] = placeMarker(location);
+                    }
+                }
+            });
+        }
+    });
+}
 
-
-
-
-
+function getPositions(refresh) {
+    var bounds = map.getBounds()
+    if (!bounds) {
+        return;
+    }
+    var sw = bounds.getSouthWest()
+    var ne = bounds.getNorthEast()
+    var z = Math.min(map.getZoom(), max_tile_zoom)
+    var n = Math.pow(2, z)
+    // clusters differ per zoom level
+    if (z != shownZoom) {
+        clearMarkers()
+        shownZoom = z
+    }
+    var xFirst = long2tile(sw.lng(), z)
+    var xLast = long2tile(ne.lng(), z)
+    if (xLast < xFirst) {
+        // the view crosses the antimeridian
+        xLast += n
+    }
+    var yFirst = Math.max(lat2tile(ne.lat(), z), 0)
+    var yLast = Math.min(lat2tile(sw.lat(), z), n - 1)
+    for (var x = xFirst; x <= Math.min(xLast, xFirst + n - 1); x++) {
+        for (var y = yFirst; y <= yLast; y++) {
+            showTile(z, ((x % n) + n) % n, y, refresh === true)
+        }
+    }
+}
@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+
+# 'float32' converts as is, 'dynamic' stores int8 weights, 'int8' also runs
+# the activations in int8, calibrated on sample tiles
+QUANTIZATIONS = ('float32', 'float16', 'dynamic', 'int8')
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png')
+
+
+def load_interpreter(path, threads):
+    # the standalone runtime is enough to run a model on CPU only hosts
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=path, num_threads=threads)
+
+
+class TFLiteModel:
+    """ Run an exported TFLite model behind the interface of ModelRegistry.
+
+    The interpreter is created on first use. It is not thread safe, so
+    predictions of concurrent callers run one after the other.
+    """
+
+    def __init__(self, path, version, threads=None):
+        self.path = path
+        self.version = version
+        self.threads = threads or os.cpu_count()
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self._interpreter = None
+        self._input_shape = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._interpreter is not None
+
+    def get(self):
+        with self._lock:
+            if self._interpreter is None:
+                start = time.perf_counter()
+                interpreter = load_interpreter(self.path, self.threads)
+                interpreter.allocate_tensors()
+                self._input = interpreter.get_input_details()[0]['index']
+                self._output = interpreter.get_output_details()[0]['index']
+                self.load_seconds = time.perf_counter() - start
+                print(f'Loaded model {self.version} in {self.load_seconds:.2f}s')
+                self._interpreter = interpreter
+        return self._interpreter
+
+    def predict(self, images_batch, batch_size):
+        interpreter = self.get()
+        outputs = []
+        with self._lock:
+            for i in range(0, len(images_batch), batch_size):
+                chunk = np.ascontiguousarray(images_batch[i:i + batch_size],
+                                             dtype=np.float32)
+                # reallocating is slow, so only when the batch shape changes
+                if chunk.shape != self._input_shape:
+                    interpreter.resize_tensor_input(self._input, chunk.shape)
+                    interpreter.allocate_tensors()
+                    self._input_shape = chunk.shape
+                interpreter.set_tensor(self._input, chunk)
+                interpreter.invoke()
+                outputs.append(interpreter.get_tensor(self._output).copy())
+        return np.concatenate(outputs)
+
+    def warmup(self, batch_size, image_size):
+        self.get()
+        start = time.perf_counter()
+        dummy = np.zeros((batch_size,) + tuple(image_size) + (3,), dtype=np.float32)
+        self.predict(dummy, batch_size)
+        self.warmup_seconds = time.perf_counter() - start
+        print(f'Warmed up model {self.version} in {self.warmup_seconds:.2f}s')
+
+    def status(self):
+        return {
+            'version': self.version,
+            'backend': 'tflite',
+            'loaded': self.loaded,
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': self.warmup_seconds,
+        }
+
+
+def image_files(directory):
+    """ The image files below a directory, sorted. """
+    return sorted(os.path.join(root, name)
+                  for root, _, names in os.walk(directory)
+                  for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def export_tflite(keras_path, output, quantization, calibration_files=()):
+    """ Convert the Keras model into a TFLite file with the given quantization. """
+    import tensorflow as tf
+    from anaspingpong.prediction import decode_files, encode
+
+    model = tf.keras.models.load_model(keras_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if not calibration_files:
+            raise ValueError('int8 quantization needs calibration tiles')
+
+        def representative_dataset():
+            for path in calibration_files:
+                batch, _ = decode_files([path])
+                if len(batch):
+                    yield [encode(batch)]
+
+        # input and output stay float32, so the model takes the same batches
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    data = converter.convert()
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+
+def compare_models(reference, candidate, files, batch_size, threshold):
+    """ Score the files with both models and compare probabilities and decisions.
+
+    Positives are the tiles the reference model puts above threshold; recall
+    is the share of them the candidate keeps. Both models are loaded and
+    warmed up before the timed batches. Raises ValueError when none of the
+    files decode.
+    """
+    from anaspingpong.prediction import IMAGE_SIZE, decode_files, encode
+
+    reference.warmup(batch_size, IMAGE_SIZE)
+    candidate.warmup(batch_size, IMAGE_SIZE)
+    expected, actual = [], []
+    seconds = {'reference': 0.0, 'candidate': 0.0}
+    for i in range(0, len(files), batch_size):
+        batch, _ = decode_files(files[i:i + batch_size])
+        if not len(batch):
+            continue
+        images = encode(batch)
+        for name, model, scores in (('reference', reference, expected),
+                                    ('candidate', candidate, actual)):
+            start = time.perf_counter()
+            scores.append(model.predict(images, batch_size)[:, 0])
+            seconds[name] += time.perf_counter() - start
+    if not expected:
+        raise ValueError('none of the tiles could be decoded')
+    expected = np.concatenate(expected)
+    actual = np.concatenate(actual)
+    difference = np.abs(expected - actual)
+    positive = expected > threshold
+    kept = actual > threshold
+    return {
+        'tiles': len(expected),
+        'mean_abs_difference': float(difference.mean()),
+        'max_abs_difference': float(difference.max()),
+        'decision_agreement': float((positive == kept).mean()),
+        'reference_positives': int(positive.sum()),
+        'lost_positives': int((positive & ~kept).sum()),
+        'new_positives': int((~positive & kept).sum()),
+        'recall': float((positive & kept).sum() / positive.sum()) if positive.any() else None,
+        'reference_ms_per_tile': seconds['reference'] / len(expected) * 1e3,
+        'candidate_ms_per_tile': seconds['candidate'] / len(expected) * 1e3,
+    }
+
+
+@click.command('export-tflite')
+@click.option('--quantization', type=click.Choice(QUANTIZATIONS), default='float16',
+              show_default=True)
+@click.option('--calibration', type=click.Path(exists=True, file_okay=False),
+              help='Folder of sample tiles to calibrate int8 activations on.')
+@click.option('--calibration-size', default=200, show_default=True,
+              help='Number of calibration tiles to use.')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Defaults to TFLITE_MODEL_PATH.')
+@with_appcontext
+def export_tflite_command(quantization, calibration, calibration_size, output):
+    """Export the Keras model to a reduced precision TFLite file."""
+    output = output or current_app.config['TFLITE_MODEL_PATH']
+    files = image_files(calibration)[:calibration_size] if calibration else ()
+    size = export_tflite(current_app.config['MODEL_PATH'], output, quantization, files)
+    click.echo(f'Wrote {size / 2 ** 20:.1f} MiB to {output}.')
+
+
+@click.command('model-parity')
+@click.argument('tiles', type=click.Path(exists=True, file_okay=False))
+@click.option('--tflite', 'tflite_path', type=click.Path(exists=True, dir_okay=False),
+              help='Defaults to TFLITE_MODEL_PATH.')
+@click.option('--limit', type=int, help='Compare on at most this many tiles.')
+@click.option('--batch-size', default=32, show_default=True)
+@with_appcontext
+def model_parity_command(tiles, tflite_path, limit, batch_size):
+    """Compare a TFLite export with the Keras model on a folder of tiles."""
+    from anaspingpong.model import ModelRegistry
+    from anaspingpong.prediction import THRESHOLD
+
+    config = current_app.config
+    reference = ModelRegistry(config['MODEL_PATH'], config['MODEL_VERSION'])
+    candidate = TFLiteModel(tflite_path or config['TFLITE_MODEL_PATH'],
+                            'candidate', config['TFLITE_THREADS'])
+    files = image_files(tiles)[:limit]
+    if not files:
+        raise click.ClickException(f'No tiles found in {tiles}.')
+    try:
+        report = compare_models(reference, candidate, files, batch_size, THRESHOLD)
+    except ValueError as e:
+        raise click.ClickException(f'{e} in {tiles}.')
+    click.echo(f'Compared on {report.pop("tiles")} tiles at threshold {THRESHOLD}:')
+    for key, value in report.items():
+        click.echo(f'{key}: {value}')
+
+
+def init_app(app):
+    app.cli.add_command(export_tflite_command)
+    app.cli.add_command(model_parity_command)
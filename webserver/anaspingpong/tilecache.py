@@ -0,0 +1,211 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from anaspingpong import metrics
+from anaspingpong.utils import Utils
+
+CACHE_LOOKUPS = metrics.counter('anaspingpong_tile_cache_lookups',
+                                'Tile cache lookups by result, hit or miss.',
+                                labels=('result',))
+
+
+class TileCache:
+    """ Persistent on-disk tile store with LRU eviction bounded by size and age.
+
+    Tiles are stored as <directory>/<source key>/<z>/<x>/<y>.jpeg, the same
+    layout the createdata scripts read, so a cache directory can be used
+    directly as their tile folder. Recency is kept in the file access time and
+    the download time in the modification time, so the LRU order survives
+    restarts.
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30, max_age=30 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = None  # path -> (size, stored_at), least recent first
+        self._bytes = 0
+
+    @staticmethod
+    def source_key(source):
+        return hashlib.sha1(source.encode('utf8')).hexdigest()[:10]
+
+    def tile_path(self, source, x, y, z):
+        return os.path.join(self.directory, self.source_key(source),
+                            str(z), str(x), f'{y}.jpeg')
+
+    def _load(self):
+        # build the LRU index from what is already on disk, oldest access first
+        if self._entries is not None:
+            return
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.jpeg'):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                found.append((stat.st_atime, path, stat.st_size, stat.st_mtime))
+        found.sort()
+        self._entries = OrderedDict(
+            (path, (size, stored_at)) for _, path, size, stored_at in found)
+        self._bytes = sum(size for size, _ in self._entries.values())
+
+    def _remove(self, path):
+        size, _ = self._entries.pop(path)
+        self._bytes -= size
+        self.evictions += 1
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        expired = time.time() - self.max_age
+        for path, (size, stored_at) in list(self._entries.items()):
+            if self._bytes <= self.max_bytes and stored_at >= expired:
+                break
+            self._remove(path)
+
+    def _lookup(self, path):
+        """ Return the path of a fresh cached tile and mark it as recently used. """
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if entry[1] < time.time() - self.max_age:
+            self._remove(path)
+            return None
+        self._entries.move_to_end(path)
+        try:
+            os.utime(path, (time.time(), entry[1]))
+        except FileNotFoundError:
+            # removed behind our back (e.g. by another worker evicting)
+            self._entries.pop(path)
+            self._bytes -= entry[0]
+            return None
+        return path
+
+    def get(self, source, x, y, z):
+        """ Return the cached tile bytes, or None on a miss. """
+        path = self.tile_path(source, x, y, z)
+        with self._lock:
+            self._load()
+            path = self._lookup(path)
+            if path is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(result='miss')
+                return None
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result='hit')
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, source, x, y, z, data):
+        """ Store tile bytes and return the path of the cached file. """
+        path = self.tile_path(source, x, y, z)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{Utils.randomString()}.part'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        self._add(temp_path, path)
+        return path
+
+    def _add(self, temp_path, path):
+        os.replace(temp_path, path)
+        with self._lock:
+            self._load()
+            if path in self._entries:
+                self._bytes -= self._entries.pop(path)[0]
+            size = os.path.getsize(path)
+            self._entries[path] = (size, time.time())
+            self._bytes += size
+            self._evict()
+
+    def fetch_many(self, source, tiles, fetcher):
+        """ Read-through lookup of many (x, y, z) tiles.
+
+        Misses are downloaded together with fetcher.fetch_many and stored.
+        Returns {tile: (status code, tile bytes or None)}.
+        """
+        results = {}
+        missing = []
+        with self._lock:
+            self._load()
+            for tile in tiles:
+                path = self._lookup(self.tile_path(source, *tile))
+                if path is None:
+                    self.misses += 1
+                    missing.append(tile)
+                else:
+                    self.hits += 1
+                    results[tile] = (200, path)
+        CACHE_LOOKUPS.inc(len(results), result='hit')
+        CACHE_LOOKUPS.inc(len(missing), result='miss')
+
+        for tile, (code, path) in list(results.items()):
+            try:
+                with open(path, 'rb') as f:
+                    results[tile] = (code, f.read())
+            except FileNotFoundError:
+                # evicted by a concurrent writer since the lookup
+                missing.append(tile)
+        for tile, (code, data) in fetcher.fetch_many(source, missing).items():
+            if data is not None:
+                self.put(source, *tile, data)
+            results[tile] = (code, data)
+        return results
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._entries = OrderedDict()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                'tiles': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def get_tile_cache():
+    return current_app.extensions['tile_cache']
+
+
+@click.command('tile-cache')
+@click.option('--clear', is_flag=True, help='Delete all cached tiles.')
+@with_appcontext
+def tile_cache_command(clear):
+    """Show statistics of the tile cache, or clear it."""
+    cache = get_tile_cache()
+    if clear:
+        cache.clear()
+        click.echo('Cleared the tile cache.')
+    for key, value in cache.stats().items():
+        click.echo(f'{key}: {value}')
+
+
+def init_app(app):
+    app.extensions['tile_cache'] = TileCache(
+        app.config['TILE_CACHE_DIR'],
+        max_bytes=app.config['TILE_CACHE_MAX_BYTES'],
+        max_age=app.config['TILE_CACHE_MAX_AGE'],
+    )
+    app.cli.add_command(tile_cache_command)
@@ -0,0 +1,52 @@
+""" Cut images into tiles as views, without copying pixels.
+
+A mosaic of tiles and the tiles cut from it share one buffer. tile_grid
+gives the aligned tiles of a mosaic as a writable view, windows any tile
+sized windows at any stride and offset as a read-only view, e.g. the half
+tile shifted views the models also score. Arrays keep their dtype, uint8
+imagery stays uint8.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def _pair(value):
+    return (value, value) if np.isscalar(value) else tuple(value)
+
+
+def tile_grid(image, size):
+    """ The (rows, cols, size, size, ...) view of the aligned tiles of an image.
+
+    The image must be whole tiles high and wide. Writing to the view writes
+    to the image.
+    """
+    height, width = image.shape[:2]
+    if height % size or width % size:
+        raise ValueError(f'a {height}x{width} image is not made of {size}px tiles')
+    grid = image.reshape((height // size, size, width // size, size) + image.shape[2:])
+    return grid.swapaxes(1, 2)
+
+
+def windows(image, size, stride=None, offset=0):
+    """ The (rows, cols, size, size, ...) read-only view of windows of an image.
+
+    Windows are size pixels square and start offset pixels from the top left
+    corner, moved by stride pixels, both an int or a (down, right) pair.
+    The stride defaults to size, so windows(image, size, offset=size // 2)
+    are the tiles shifted by half a tile and windows(image, size, size // 2)
+    the tiles together with all their half tile shifted views. Windows that
+    would reach past the image are left out.
+    """
+    size = _pair(size)
+    stride = _pair(stride) if stride is not None else size
+    offset = _pair(offset)
+    image = image[offset[0]:, offset[1]:]
+    rows = max((image.shape[0] - size[0]) // stride[0] + 1, 0)
+    cols = max((image.shape[1] - size[1]) // stride[1] + 1, 0)
+    strides = image.strides
+    return as_strided(
+        image,
+        shape=(rows, cols) + size + image.shape[2:],
+        strides=(strides[0] * stride[0], strides[1] * stride[1]) + strides,
+        writeable=False,
+    )
@@ -20,9 +20,21 @@ import glob
 import os
 import base64
 import math
+import io
 
+import numpy as np
 from PIL import Image
 
+from anaspingpong import geo, metrics, quadkey
+
+SCALED_CHILD_FAILURES = metrics.counter(
+    'anaspingpong_scaled_tile_child_failures',
+    'Fetched children of scaled tiles left out, by reason, decode or size.',
+    labels=('reason',))
+
+# a hex digit of interleaved x and y bits as two quadkey digits
+_HEX_TO_QUAD = str.maketrans({f"{d:x}": f"{d >> 2}{d & 3}" for d in range(16)})
+
 
 class Utils:
 
@@ -31,29 +43,18 @@ class Utils:
         return uuid.uuid4().hex.upper()[0:6]
 
     def getChildTiles(x, y, z):
-        childX = x * 2
-        childY = y * 2
-        childZ = z + 1
-
-        return [
-            (childX, childY, childZ),
-            (childX + 1, childY, childZ),
-            (childX + 1, childY + 1, childZ),
-            (childX, childY + 1, childZ),
-        ]
+        # clockwise from the top left, the order mergeQuadTile expects
+        children = quadkey.children(quadkey.encode(x, y, z))
+        return [quadkey.decode(children[i]) for i in (0, 1, 3, 2)]
 
     def makeQuadKey(tile_x, tile_y, level):
-        quadkey = ""
-        for i in range(level):
-            bit = level - i
-            digit = ord('0')
-            mask = 1 << (bit - 1)  # if (bit - 1) > 0 else 1 >> (bit - 1)
-            if (tile_x & mask) != 0:
-                digit += 1
-            if (tile_y & mask) != 0:
-                digit += 2
-            quadkey += chr(digit)
-        return quadkey
+        if level == 0:
+            return ""
+        # x and y bits as base 4 digits add up to the quadkey digits, written
+        # as hex every character is two of them
+        digits = int(format(tile_x, "b"), 4) + 2 * int(format(tile_y, "b"), 4)
+        quadkey = format(digits, "0" + str((level + 1) // 2) + "x").translate(_HEX_TO_QUAD)
+        return quadkey[level % 2:]
 
     @staticmethod
     def num2deg(xtile, ytile, zoom):
@@ -137,46 +138,95 @@ class Utils:
         return code
 
     @staticmethod
-    def downloadFileScaled(url, destination, x, y, z, outputScale):
-
-        if outputScale == 1:
-            return Utils.downloadFile(url, destination, x, y, z)
-
-        elif outputScale == 2:
-
-            childTiles = Utils.getChildTiles(x, y, z)
-            childImages = []
-
-            for childX, childY, childZ in childTiles:
-
-                tempFile = Utils.randomString() + ".png"
-                tempFilePath = os.path.join("../temp", tempFile)
-
-                code = Utils.downloadFile(url, tempFilePath, childX, childY, childZ)
+    def buildScaledTile(url, x, y, z, outputScale, fetcher=None, cache=None):
+        """ Fetch the children of a tile concurrently and merge them in memory.
+
+        outputScale is a power of two, each side of the result holds that many
+        children of zoom z + log2(outputScale). Returns (status code, uint8
+        (height, width, 3) array or None, children left out). Children that
+        failed to download or decode, or whose size differs from the first
+        fetched child's, are left out and stay black; when none could be used
+        the code is that of a failed child, or -1.
+        """
+        if outputScale < 1 or outputScale & (outputScale - 1):
+            raise ValueError(f'outputScale must be a power of two, not {outputScale}')
+
+        childZ = z + outputScale.bit_length() - 1
+        childTiles = [(x * outputScale + col, y * outputScale + row, childZ)
+                      for row in range(outputScale) for col in range(outputScale)]
+
+        ownFetcher = fetcher is None
+        if ownFetcher:
+            from anaspingpong.fetcher import TileFetcher
+            fetcher = TileFetcher(max_workers=min(len(childTiles), 16))
+        try:
+            if cache is not None:
+                results = cache.fetch_many(url, childTiles, fetcher)
+            else:
+                results = fetcher.fetch_many(url, childTiles)
+        finally:
+            if ownFetcher:
+                fetcher.close()
+
+        # the canvas is sized by the header of the first fetched child, the
+        # other children must have the same size
+        canvas = None
+        failed = []
+        for childX, childY, childZ in childTiles:
+            code, data = results[(childX, childY, childZ)]
+            if code != 200:
+                failed.append((childX, childY, childZ))
+                continue
+            try:
+                image = Image.open(io.BytesIO(data))
+                if canvas is None:
+                    width, height = image.size
+                    canvas = np.zeros((height * outputScale, width * outputScale, 3),
+                                      dtype=np.uint8)
+                if image.size != (width, height):
+                    SCALED_CHILD_FAILURES.inc(reason='size')
+                    failed.append((childX, childY, childZ))
+                    continue
+                image = image.convert('RGB')
+            except (OSError, Image.DecompressionBombError):
+                SCALED_CHILD_FAILURES.inc(reason='decode')
+                failed.append((childX, childY, childZ))
+                continue
+            row = childY - y * outputScale
+            col = childX - x * outputScale
+            canvas[row * height:(row + 1) * height, col * width:(col + 1) * width] = image
+
+        if len(failed) == len(childTiles):
+            codes = [code for code, _ in results.values() if code != 200]
+            return (codes[0] if codes else -1), None, failed
+        return 200, canvas, failed
 
-                if code == 200:
-                    image = Image.open(tempFilePath)
-                else:
-                    return code
+    @staticmethod
+    def downloadFileScaled(url, destination, x, y, z, outputScale, cache=None, fetcher=None):
 
-                childImages.append(image)
+        code, canvas, _ = Utils.buildScaledTile(url, x, y, z, outputScale,
+                                                fetcher=fetcher, cache=cache)
+        if canvas is None:
+            return code
 
-            canvas = Utils.mergeQuadTile(childImages)
-            canvas.save(destination, "PNG")
+        Image.fromarray(canvas).save(destination, "PNG")
 
-            return 200
+        return 200
 
+    # single values; anaspingpong.geo converts whole arrays the same way
 
     def long2tile(lon, zoom):
-        return math.floor((lon + 180) / 360 * math.pow(2, zoom))
-
+        n = 1 << zoom
+        x = math.floor((lon + 180) / 360 * n)
+        # 180 degrees east is the right edge of the last tile
+        return x if 0 <= x < n else (0 if x < 0 else n - 1)
 
     def lat2tile(lat, zoom):
-        return math.floor(
-            (1 -
-             math.log(math.tan(lat * math.pi / 180) + 1 / math.cos(lat * math.pi / 180))
-             / math.pi) / 2 * math.pow(2, zoom)
-            )
+        n = 1 << zoom
+        if not -geo.MAX_LATITUDE <= lat <= geo.MAX_LATITUDE:
+            lat = geo.MAX_LATITUDE if lat > 0 else -geo.MAX_LATITUDE
+        y = math.floor((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return y if 0 <= y < n else (0 if y < 0 else n - 1)
 
     def tile2long(x, z):
         return (x + 0.5) / math.pow(2, z) * 360 - 180
@@ -184,7 +234,3 @@ class Utils:
     def tile2lat(y, z):
         n = math.pi - 2 * math.pi * (y + .5) / math.pow(2, z)
         return 180 / math.pi * math.atan(0.5 * (math.exp(n) - math.exp(-n)))
-
-
-
-